@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks of the conversion scripts.  Each benchmark prints one line per
+measurement with the best time of several repetitions.
+
+Usage: benchmark.py [-n repeat] [wrfout [benchmark ...]]
+
+Without a file only the import benchmark is run, otherwise all benchmarks or
+the ones given.
+
+Benchmarks:
+  import    : interpreter startup and module import time in a new process, and
+              whether matplotlib was imported
+  overlay   : time and freshly allocated memory to create an overlay image,
+              rendered with numpy (npixels) and with matplotlib (hsize), both
+              colored by the fused kernel
+  perimeter : time to extract the fire perimeter of a time step
+  backend   : read throughput and peak resident memory of reading every time
+              slice of the float variables with each NetCDF backend, in a new
+              process each (the mmap backend needs a classic format file, the
+              pages of the mapped file count towards its resident memory but
+              belong to the page cache shared with other processes)
+  normalize : time and freshly allocated memory per frame of the color mapping
+              (unit conversion, normalization, quantization and coloring of a
+              heat flux frame read from the file and tiled to at least 4
+              million cells), for the separate numpy operations, for the fused
+              kernel on a converted frame and for the kernel applying the
+              conversion factor itself
+'''
+
+import subprocess
+import resource
+import time
+import sys,os
+
+modules=('ncEarth','lfn2kml','ncBatch','nc2kml_sequence')
+
+def best(f,repeat):
+    '''Return the minimum wall time of repeat calls of f.'''
+    t=[]
+    for i in xrange(repeat):
+        t0=time.time()
+        f()
+        t.append(time.time()-t0)
+    return min(t)
+
+def bench_import(filename,repeat):
+    path=os.path.dirname(os.path.abspath(__file__))
+    cmd='import sys,time;t=time.time();import %s;'+ \
+        'print time.time()-t,sys.modules.has_key("matplotlib")'
+    t=best(lambda : subprocess.call([sys.executable,'-c','pass']),repeat)
+    print 'startup     %-16s %8.4f s' % ('python',t)
+    for m in modules:
+        out=[]
+        def run():
+            p=subprocess.Popen([sys.executable,'-c',cmd % m],cwd=path,stdout=subprocess.PIPE)
+            out.append(p.communicate()[0].split())
+        t=best(run,repeat)
+        timp=min([float(o[0]) for o in out])
+        print 'import      %-16s %8.4f s  (import %.4f s, matplotlib loaded: %s)' % (m,t,timp,out[-1][1])
+
+def bench_overlay(filename,repeat):
+    from ncEarth import ncWRFFireLog
+    kml=ncWRFFireLog(filename,istep=0)
+    n=kml.f.variables['Times'].shape[0]
+    istep=n/2
+    for opts in ({'npixels':10**6},{}):
+        kml=ncWRFFireLog(filename,istep=istep,**opts)
+        v=kml.get_array('FGRNHFX')
+        min,max=kml.get_minmax('FGRNHFX')
+        f=lambda : kml.get_image(v,min,max)
+        t=best(f,repeat)
+        m=faults(f,repeat)
+        name=opts and 'numpy' or 'matplotlib'
+        print 'overlay     %-16s %8.4f s  (%.1f MB allocated per frame)' % (name,t,m)
+
+def faults(f,repeat):
+    '''Return the memory in MB newly touched by one call of f, measured by the
+    minor page faults, after a first call that may allocate reused buffers.
+    Large arrays are mapped from and returned to the system on each allocation
+    and in pages of the base size (glibc and Linux only), otherwise freed
+    temporaries are reused without page faults and a huge page is counted as
+    one base page.'''
+    try:
+        import ctypes
+        libc=ctypes.CDLL(None)
+        # M_MMAP_THRESHOLD, setting it also turns off its dynamic adjustment
+        libc.mallopt(-3,1<<17)
+        # PR_SET_THP_DISABLE
+        libc.prctl(41,1,0,0,0)
+    except (OSError,AttributeError):
+        pass
+    f()
+    n=resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    for i in xrange(repeat):
+        f()
+    n=resource.getrusage(resource.RUSAGE_SELF).ru_minflt-n
+    return n*resource.getpagesize()/float(repeat)/2**20
+
+def normalize(v,min,max,log=False):
+    '''Scale data to [0,1] on a linear or log scale with separate numpy
+    operations, the reference that ncEarth.ncFrameKernel is checked against.
+    Values that cannot be displayed are masked.'''
+    import numpy as np
+    v=np.ma.masked_invalid(v,copy=False)
+    if log:
+        v=np.ma.masked_less_equal(v,0.,copy=False)
+        return (np.ma.log(v)-np.log(min))/(np.log(max)-np.log(min))
+    if max == min:
+        return v*0.
+    return (v-min)/float(max-min)
+
+def colorize(x,lut):
+    '''Map a normalized (masked) array to an RGBA image with a lookup table from
+    ncEarth.get_lut, values outside of [0,1] get the first or last color like
+    matplotlib's colormaps.'''
+    import numpy as np
+    n=lut.shape[0]-1
+    x=np.ma.filled(x,np.nan)*n
+    bad=~np.isfinite(x)
+    x[bad]=0.
+    idx=np.clip(np.floor(x),0,n-1).astype(np.intp)
+    idx[bad]=n
+    return lut[idx]
+
+def bench_normalize(filename,repeat):
+    import numpy as np
+    import ncEarth
+    kml=ncEarth.ncWRFFireLog(filename,istep=0)
+    istep=kml.f.variables['Times'].shape[0]/2
+    kml=ncEarth.ncWRFFireLog(filename,istep=istep)
+    v=kml.get_frame('FGRNHFX')
+    scale=kml.get_scale('FGRNHFX')
+    n=int(np.ceil(np.sqrt(4e6/v.size)))
+    v=np.tile(v,(n,n))
+    min,max=kml.get_minmax('FGRNHFX')
+    lut=ncEarth.get_lut('jet')
+    kernel=ncEarth.ncFrameKernel()
+    for name,f in (('numpy',lambda : colorize(normalize(v*scale,min,max,True),lut)),
+                   ('kernel',lambda : kernel.colorize(v*scale,min,max,lut,True)),
+                   ('kernel scale',lambda : kernel.colorize(v,min,max,lut,True,scale))):
+        t=best(f,repeat)
+        m=faults(f,repeat)
+        print 'normalize   %-16s %8.4f s  (%.1f MB allocated per %ix%i frame)' % (name,t,m,v.shape[0],v.shape[1])
+
+def bench_backend(filename,repeat):
+    path=os.path.dirname(os.path.abspath(__file__))
+    cmd='''import sys,time,resource
+import numpy as np
+import ncEarth
+ncEarth.set_backend(sys.argv[1])
+f=ncEarth.Dataset(sys.argv[2],'r')
+vs=[v for v in f.variables.values() if v.dtype.kind == 'f' and v.shape and v.shape[0] > 0]
+nt=max([v.shape[0] for v in vs])
+n=0
+t=time.time()
+for i in xrange(nt):
+    for v in vs:
+        if i < v.shape[0]:
+            a=v[i]
+            a.max()
+            n=n+a.nbytes
+print time.time()-t,n,resource.getrusage(resource.RUSAGE_SELF).ru_maxrss'''
+    import ncMmap
+    names=['netCDF4']
+    if ncMmap.isclassic(filename):
+        names.append('mmap')
+    for name in names:
+        out=[]
+        def run():
+            p=subprocess.Popen([sys.executable,'-c',cmd,name,os.path.abspath(filename)],cwd=path,stdout=subprocess.PIPE)
+            out.append(p.communicate()[0].split())
+        best(run,repeat)
+        t=min([float(o[0]) for o in out])
+        nbytes=float(out[-1][1])
+        rss=min([int(o[2]) for o in out])/1024.
+        print 'backend     %-16s %8.4f s  (%.0f MB/s, max RSS %.1f MB)' % (name,t,nbytes/t/2**20,rss)
+
+def bench_perimeter(filename,repeat):
+    import lfn2kml
+    n=lfn2kml.ntimes(filename)
+    t=best(lambda : lfn2kml.getpts(filename,n-1),repeat)
+    print 'perimeter   %-16s %8.4f s' % ('getpts',t)
+    fire=lfn2kml.getfire(filename,n-1)
+    t=best(lambda : lfn2kml.perimeterstats(filename,n-1,fire),repeat)
+    print 'perimeter   %-16s %8.4f s' % ('perimeterstats',t)
+
+benchmarks=(('import',bench_import),
+            ('overlay',bench_overlay),
+            ('normalize',bench_normalize),
+            ('perimeter',bench_perimeter),
+            ('backend',bench_backend))
+
+if __name__ == '__main__':
+    args=sys.argv[1:]
+    repeat=5
+    if len(args) > 1 and args[0] == '-n':
+        repeat=int(args[1])
+        args=args[2:]
+    if not args:
+        bench_import(None,repeat)
+    else:
+        filename=args[0]
+        names=args[1:] or [b[0] for b in benchmarks]
+        for name,f in benchmarks:
+            if name in names:
+                f(filename,repeat)
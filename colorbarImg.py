@@ -1,7 +1,7 @@
 '''
 A script that dynamically generates log scaled color bar images from a NetCDF dataset for each step with data.
 
-Requires matplotlib and Scientific python.
+Requires matplotlib, the NetCDF file is opened with the backend selected in ncEarth.
 
 Use as follows:
 
@@ -9,10 +9,7 @@ import colorbarImg
 colorbarImg.getImages('wrfout.nc','FGRNHFX')
 '''
 
-try:
-    from netCDF4 import Dataset
-except:
-    from Scientific.IO.NetCDF import NetCDFFile as Dataset
+from ncEarth import Dataset
 import pylab
 import scipy
 from numpy import *
@@ -1,14 +1,12 @@
 #!/usr/bin/env python
 
-import matplotlib
-try:
-    matplotlib.use('Agg')
-except:
-    pass
-
-from netCDF4 import Dataset
-from pylab import contour
-import sys
+import ncEarth
+from ncEarth import Dataset
+from datetime import datetime
+import numpy as np
+import json
+import csv
+import os,sys
 
 kmlstr= \
 '''<?xml version="1.0" encoding="UTF-8"?>
@@ -33,6 +31,7 @@ placestr= \
 '''<Placemark>
     <name>Fire perimeter at %(time)s</name>
     <styleUrl>#redLine</styleUrl>
+    %(stats)s
     %(timestr)s
     <MultiGeometry>
     %(poly)s
@@ -52,6 +51,19 @@ polystr= \
       </outerBoundaryIs>
     </Polygon>'''
 
+# fire statistics of a perimeter, see statskml
+statstr= \
+'''<description>Burned area %(ha).2f ha, perimeter %(km).3f km%(rate)s</description>
+    <ExtendedData>
+      <Data name="area_m2"><value>%(area_m2).1f</value></Data>
+      <Data name="perimeter_m"><value>%(perimeter_m).1f</value></Data>%(growth)s
+    </ExtendedData>'''
+growthstr= \
+'''
+      <Data name="growth_m2_s"><value>%.4f</value></Data>'''
+
+radius=6371008.8  # mean radius of the earth in m
+
 # time interval specification for animated output
 timestr=\
 '''<TimeSpan>
@@ -62,13 +74,18 @@ timestr=\
 beginstr='<begin>%s</begin>'
 endstr='<end>%s</end>'
 wrftimestr='%Y-%m-%d_%H:%M:%S'
+isotimestr='%Y-%m-%dT%H:%M:%S'   # times returned by gettime
 
-def getpts(file,nstep=-1):
-    f=Dataset(file,'r')
-    if f.variables['LFN'].shape[0] == 1:
-        lfn=f.variables['LFN'][0,:,:]
-    else:
-        lfn=f.variables['LFN'][nstep,:,:]
+def getfire(file,nstep=-1,vname='LFN'):
+    '''Return the level set function of a time step and the fire grid coordinates
+    (without the extra row and column of the subgrid) as (lfn,x,y).  Another
+    fire grid variable, in the file or derived (see ncEarth.register), can be
+    contoured instead of LFN.'''
+    fire=ncEarth.ncWRFFire(file)
+    f=fire.f
+    if f.variables[ncEarth.source_name(vname)].shape[0] == 1:
+        nstep=0
+    lfn=fire.get_slice(vname,nstep)
     
     (fny,fnx)=lfn.shape
     nx=len(f.dimensions['west_east'])+1
@@ -77,19 +94,101 @@ def getpts(file,nstep=-1):
     (srx,sry)=(fnx/nx,fny/ny)
     
     lfn=lfn[:-sry,:-srx]
+    x=getgeometry(f,file,'FXLONG')[:-sry,:-srx]
+    y=getgeometry(f,file,'FXLAT')[:-sry,:-srx]
+    return (lfn,x,y)
+
+def getgeometry(f,file,name):
+    '''Return a coordinate array, from shared memory if it was provided by another
+    process.'''
+    if ncEarth.geometry.has_key((file,name)):
+        return ncEarth.geometry[(file,name)]
+    return f.variables[name][0,:,:]
+
+def getpts(file,nstep=-1,fire=None,vname='LFN'):
+    '''Return the fire perimeter of a time step as a list of rings, or None if
+    there is no fire.  The arrays returned by getfire can be given instead of
+    reading the file.'''
+    if fire is None:
+        fire=getfire(file,nstep,vname)
+    lfn,x,y=fire
     
     if (lfn > 0).all():
         return None
     
-    x=f.variables['FXLONG'][0,:-sry,:-srx]
-    y=f.variables['FXLAT'][0,:-sry,:-srx]
-    c=contour(x,y,lfn,[0]).collections[0]
-    
-    p=c.get_paths()
-    poly=[]
-    for i in p:
-        poly.extend(i.to_polygons())
-    return poly
+    return contour(x,y,lfn,0.)
+
+# line segments of each marching squares case (bit 1,2,4,8 set for the corners
+# (i,j),(i,j+1),(i+1,j+1),(i+1,j) inside the contour) as pairs of cell edges
+# 0=left, 1=bottom, 2=right, 3=top, the saddle cases 5 and 10 have a second
+# table for cells whose center is inside
+L,B,R,T=0,1,2,3
+segments={1:[(L,B)],2:[(B,R)],3:[(L,R)],4:[(R,T)],5:[(L,B),(R,T)],6:[(B,T)],
+          7:[(L,T)],8:[(L,T)],9:[(B,T)],10:[(B,R),(L,T)],11:[(R,T)],12:[(L,R)],
+          13:[(B,R)],14:[(L,B)]}
+saddles={5:[(B,R),(L,T)],10:[(L,B),(R,T)]}
+
+def contour(x,y,z,level=0.):
+    '''Return the contour of z at level as a list of closed rings, each an (n,2)
+    array of x,y coordinates.  The region z < level is enclosed, rings touching
+    the boundary of the array are closed along the boundary.  This is a
+    vectorized marching squares that does not require matplotlib.'''
+    out=level+1.
+    z=np.ma.filled(z,out)
+    # pad with values outside of the contour so that every ring is closed, the
+    # padded coordinates repeat the boundary so the rings follow the boundary
+    z=np.pad(np.asarray(z,np.float64),1,mode='constant',constant_values=out)
+    x=np.pad(np.asarray(x,np.float64),1,mode='edge')
+    y=np.pad(np.asarray(y,np.float64),1,mode='edge')
+    ny,nx=z.shape
+    nh=ny*(nx-1)  # number of horizontal edges
+    b=z < level
+    case=b[:-1,:-1]*1+b[:-1,1:]*2+b[1:,1:]*4+b[1:,:-1]*8
+    i,j=np.nonzero((case > 0) & (case < 15))
+    center=((z[i,j]+z[i,j+1]+z[i+1,j+1]+z[i+1,j])/4. < level).tolist()
+    case=case[i,j].tolist()
+    # the edge ids of every active cell
+    edges=np.column_stack((nh+i*nx+j,i*(nx-1)+j,nh+i*nx+j+1,(i+1)*(nx-1)+j)).tolist()
+
+    # collect the segments of each cell and link them into rings
+    nbr={}
+    for c,inside,e in zip(case,center,edges):
+        if inside and saddles.has_key(c):
+            segs=saddles[c]
+        else:
+            segs=segments[c]
+        for e1,e2 in segs:
+            p,q=e[e1],e[e2]
+            nbr.setdefault(p,[]).append(q)
+            nbr.setdefault(q,[]).append(p)
+    rings=[]
+    while nbr:
+        start=next(iter(nbr))
+        ring=[start]
+        prev,cur=start,nbr[start][0]
+        while cur != start:
+            ring.append(cur)
+            n1,n2=nbr.pop(cur)
+            prev,cur=cur,(n2 if n1 == prev else n1)
+        del nbr[start]
+        ring.append(start)
+        rings.append(ring)
+    if not rings:
+        return []
+
+    # interpolate the position of the contour along every edge
+    e=np.concatenate(rings)
+    h=e < nh
+    i1=np.where(h,e//(nx-1),(e-nh)//nx)
+    j1=np.where(h,e%(nx-1),(e-nh)%nx)
+    i2=np.where(h,i1,i1+1)
+    j2=np.where(h,j1+1,j1)
+    z1=z[i1,j1]
+    t=(level-z1)/(z[i2,j2]-z1)
+    px=x[i1,j1]+t*(x[i2,j2]-x[i1,j1])
+    py=y[i1,j1]+t*(y[i2,j2]-y[i1,j1])
+    pts=np.column_stack((px,py))
+    return np.split(pts,np.cumsum([len(r) for r in rings])[:-1])
 
 def gettime(file,nstep=-1):
     f=Dataset(file,'r')
@@ -101,12 +200,15 @@ def gettime(file,nstep=-1):
         t=f.variables['Times'][nstep].tostring()
     return t.replace('_','T')
 
-def createkml(poly,time,tstr):
+def creategeometry(poly,tstr):
     l=[]
     for p in poly:
        l.append(createpoly(p,tstr))
-    s='\n'.join(l)
-    s=placestr % {'time':time, 'poly':s, 'timestr':tstr}
+    return '\n'.join(l)
+
+def createkml(poly,time,tstr,stats=''):
+    s=creategeometry(poly,tstr)
+    s=placestr % {'time':time, 'poly':s, 'timestr':tstr, 'stats':stats}
     return s #kmlstr % s
 
 def createpoly(poly,time=''):
@@ -116,33 +218,157 @@ def createpoly(poly,time=''):
     s='\n'.join(l)
     return polystr % s
 
-def main(file,nstep=None):
-    last=False
-    only=True
-    s=[]
-    if nstep is None:
-        nstep=0
-        only=False
-    while not last:
-        time=gettime(file,nstep)
-        stime=time
-        etime=gettime(file,nstep+1)
-       if etime=='':
-            etime=stime
-            last=True
-        sstime=beginstr % stime
-        setime=endstr % etime
-        tstr=timestr % {'begin':sstime,'end':setime}
-        poly=getpts(file,nstep)
-       if poly is not None:
-            s.append(createkml(poly,time,tstr))
-        nstep=nstep+1
-        if only:
-            last=True
-    s='\n'.join(s)
+def ntimes(file):
+    f=Dataset(file,'r')
+    return len(f.variables['Times'])
+
+def cellareas(x,y):
+    '''Return the area in m^2 of the cells of a grid with longitudes x and
+    latitudes y in degrees, from the spacing of the cell centers on a sphere.'''
+    lon=np.radians(np.asarray(x,np.float64))
+    lat=np.radians(np.asarray(y,np.float64))
+    lon_i,lon_j=np.gradient(lon)
+    lat_i,lat_j=np.gradient(lat)
+    return radius**2*np.cos(lat)*np.abs(lon_j*lat_i-lon_i*lat_j)
+
+# cell areas of the fire grid of each file, keyed by (file,shape)
+areas={}
+
+def burnedarea(file,lfn,x,y):
+    '''Return the area in m^2 of the cells with lfn < 0.'''
+    key=(file,lfn.shape)
+    if not areas.has_key(key):
+        areas[key]=cellareas(x,y)
+    return float(areas[key][np.ma.filled(lfn < 0,False)].sum())
+
+def ringlength(ring):
+    '''Return the length in m of a ring of (longitude,latitude) points along
+    great circles.'''
+    lon=np.radians(ring[:,0])
+    lat=np.radians(ring[:,1])
+    a=np.sin(np.diff(lat)/2.)**2+np.cos(lat[:-1])*np.cos(lat[1:])*np.sin(np.diff(lon)/2.)**2
+    return float(2.*radius*np.arcsin(np.sqrt(np.minimum(a,1.))).sum())
+
+def growth(prev,record):
+    '''Return the growth rate of the burned area in m^2/s since the record of the
+    previous time step, or None if it is not known.'''
+    if prev is None or not prev['time'] or not record['time']:
+        return None
+    dt=datetime.strptime(record['time'],isotimestr)-datetime.strptime(prev['time'],isotimestr)
+    dt=dt.days*86400.+dt.seconds
+    if dt <= 0.:
+        return None
+    return (record['area_m2']-prev['area_m2'])/dt
+
+def statskml(record):
+    '''Return the description and ExtendedData of a Placemark for a record of
+    perimeterstats.'''
+    rate=''
+    gstr=''
+    if record['growth_m2_s'] is not None:
+        rate=', growing %.2f ha/h' % (record['growth_m2_s']*0.36)
+        gstr=growthstr % record['growth_m2_s']
+    d=dict(record)
+    d.update({'ha':record['area_m2']*1e-4,'km':record['perimeter_m']*1e-3,'rate':rate,'growth':gstr})
+    return statstr % d
+
+def perimeterdata(file,nstep,fire=None,vname='LFN'):
+    '''Return the Polygons of the fire perimeter at a time step as a kml string
+    (None if there is no fire), its TimeSpan and a record (a dictionary) of the
+    step, time, burned area in m^2 and perimeter length in m, without the
+    growth rate.  The statistics are computed from the same arrays as the
+    contour: the area from the cells with LFN < 0 with their size given by
+    FXLONG and FXLAT, the length of the rings along great circles.'''
+    time=gettime(file,nstep)
+    etime=gettime(file,nstep+1)
+    if etime=='':
+        etime=time
+    sstime=beginstr % time
+    setime=endstr % etime
+    tstr=timestr % {'begin':sstime,'end':setime}
+    if fire is None:
+        fire=getfire(file,nstep,vname)
+    poly=getpts(file,nstep,fire,vname)
+    lfn,x,y=fire
+    record={'step':nstep,'time':time,'area_m2':burnedarea(file,lfn,x,y),
+            'perimeter_m':sum([ringlength(r) for r in poly or []]),'growth_m2_s':None}
+    if poly is None:
+        return (None,tstr,record)
+    return (creategeometry(poly,tstr),tstr,record)
+
+def placemark(geometry,tstr,record,prev=None):
+    '''Return the kml Placemark (None without geometry) and the record of a time
+    step from perimeterdata, with the growth rate of the burned area in m^2/s
+    since the record prev of the previous time step.'''
+    record=dict(record)
+    record['growth_m2_s']=growth(prev,record)
+    if geometry is None:
+        return (None,record)
+    return (placestr % {'time':record['time'],'poly':geometry,'timestr':tstr,
+                        'stats':statskml(record)},record)
+
+def perimeterstats(file,nstep,fire=None,vname='LFN',prev=None):
+    '''Return the kml Placemark of the fire perimeter at a time step (None if
+    there is no fire) and its record with the growth rate since the record prev,
+    see perimeterdata and placemark.'''
+    geometry,tstr,record=perimeterdata(file,nstep,fire,vname)
+    return placemark(geometry,tstr,record,prev)
+
+def perimeter(file,nstep,fire=None,vname='LFN'):
+    '''Return the kml Placemark of the fire perimeter at a time step, or None if
+    there is no fire.'''
+    return perimeterstats(file,nstep,fire,vname)[0]
+
+statfields=('step','time','area_m2','perimeter_m','growth_m2_s')
+
+def writestats(records,basename='fire_perimeter'):
+    '''Write the records of perimeterstats as a time series to basename.csv and
+    basename.json.'''
+    f=open(basename+'.json','w')
+    json.dump(records,f,indent=1)
+    f.close()
+    f=open(basename+'.csv','wb')
+    w=csv.writer(f)
+    w.writerow(statfields)
+    for r in records:
+        w.writerow(['' if r[k] is None else r[k] for k in statfields])
+    f.close()
+
+def writekml(placemarks,kmlfile='fire_perimeter.kml'):
+    s='\n'.join(placemarks)
     s=kmlstr % s
-    f=open('fire_perimeter.kml','w')
+    f=open(kmlfile,'w')
     f.write(s)
+    f.close()
+
+def main(file,nstep=None,kmlfile='fire_perimeter.kml',chunk=None,vname='LFN'):
+    '''Write the fire perimeters (the zero contours of vname) of all time steps
+    (or one) to kmlfile, and their statistics to the csv and json files named
+    like kmlfile (see writestats).  With
+    chunk, kmlfile links to kml files of chunk time steps each, which are written
+    as the perimeters are extracted (see ncEarth.ncChunkedKml).'''
+    if nstep is None:
+        steps=range(ntimes(file))
+    else:
+        steps=[nstep]
+    chunks=None
+    if chunk:
+        chunks=ncEarth.ncChunkedKml(kmlfile,ncEarth.get_times(file),ncEarth.ncWRFFire(file).get_bounds(),
+                                    lambda content: kmlstr % content,chunk)
+    s=[]
+    records=[]
+    for i in steps:
+        p,r=perimeterstats(file,i,vname=vname,prev=records and records[-1] or None)
+        records.append(r)
+        if chunks is not None:
+            chunks.add(i,p)
+        elif p is not None:
+            s.append(p)
+    if chunks is not None:
+        chunks.close()
+    else:
+        writekml(s,kmlfile)
+    writestats(records,os.path.splitext(kmlfile)[0])
 
 '''    
 def main(argv):
@@ -161,8 +387,19 @@ def main(argv):
 
 
 if __name__ == '__main__':
+    # usage: lfn2kml.py [--chunk nframes] [--var name] wrfout [step]
+    chunk=None
+    if '--chunk' in sys.argv:
+        k=sys.argv.index('--chunk')
+        chunk=int(sys.argv[k+1])
+        del sys.argv[k:k+2]
+    vname='LFN'
+    if '--var' in sys.argv:
+        k=sys.argv.index('--var')
+        vname=sys.argv[k+1]
+        del sys.argv[k:k+2]
     if len(sys.argv[1:]) > 1:
         n=int(sys.argv[2])
     else:
         n=None
-    main(sys.argv[1],n)
+    main(sys.argv[1],n,chunk=chunk,vname=vname)
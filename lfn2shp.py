@@ -1,45 +1,207 @@
 #!/usr/bin/env python
 
-import matplotlib
-try:
-    matplotlib.use('Agg')
-except:
-    pass
-
-from netCDF4 import Dataset
-from pylab import contour
+'''
+Export the fire perimeters of a WRF-Fire output file to a polygon shapefile.
+All time steps are extracted in one pass over the file, each step with a fire
+becomes one (multi-part) polygon record with the attributes
+
+  TIME    : the WRF time string of the step
+  STEP    : the time step index in the file
+  AREA_M2 : the burned area (cells with LFN < 0) in square meters
+  PERIM_M : the length of the perimeter in meters
+  GROWTH  : the growth rate of the burned area since the previous step in m^2/s
+
+Besides the .shp, .shx and .dbf files a WGS84 .prj and a quadtree spatial
+index (.qix, the format of MapServer's shptree and GDAL) are written, so that
+GIS tools can query perimeters by location without scanning the whole file.
+
+Usage: lfn2shp.py wrfout [step [basename]]
+
+writes all steps (or the one given) to fire.shp (or <basename>.shp).
+'''
+
+from ncEarth import ncWRFFire,source_name
+from lfn2kml import contour,burnedarea,ringlength,growth
+import numpy as np
+import struct
 import shapefile
 import sys
 
-f=Dataset(sys.argv[1],'r')
-if len(sys.argv[1:]) > 1:
-    n=int(sys.argv[2])
-    lfn=f.variables['LFN'][n,:,:]
-else:
-    lfn=f.variables['LFN'][0,:,:]
+prjstr='GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137,298.257223563]],' + \
+       'PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]]'
+
+def perimeters(file,steps=None,vname='LFN'):
+    '''Yield (step,time,rings,record) for every time step with a fire, where rings
+    is the perimeter as returned by contour and record the statistics of the
+    step as returned by lfn2kml.perimeterstats.
+    The file is opened once and the coordinates are read once.  The zero
+    contour of another fire grid variable, also a derived one (see
+    ncEarth.register), can be exported instead of LFN.'''
+    fire=ncWRFFire(file)
+    f=fire.f
+    lfnv=f.variables[source_name(vname)]
+    (fny,fnx)=lfnv.shape[-2:]
+    nx=len(f.dimensions['west_east'])+1
+    ny=len(f.dimensions['south_north'])+1
+    (srx,sry)=(fnx/nx,fny/ny)
+    x=f.variables['FXLONG'][0,:-sry,:-srx]
+    y=f.variables['FXLAT'][0,:-sry,:-srx]
+    times=f.variables['Times']
+    if steps is None:
+        steps=xrange(lfnv.shape[0])
+    prev=None
+    for i in steps:
+        lfn=fire.get_slice(vname,i)[:-sry,:-srx]
+        time=times[i].tostring()
+        rings=[]
+        if not (lfn > 0).all():
+            rings=orient_rings(contour(x,y,lfn,0.))
+        record={'step':i,'time':time.replace('_','T'),'area_m2':burnedarea(file,lfn,x,y),
+                'perimeter_m':sum([ringlength(r) for r in rings])}
+        record['growth_m2_s']=growth(prev,record)
+        prev=record
+        if rings:
+            yield (i,time,rings,record)
+
+def signed_area(ring):
+    '''Return the signed area of a closed ring, positive if counterclockwise.'''
+    x,y=ring[:,0],ring[:,1]
+    return 0.5*(np.dot(x[:-1],y[1:])-np.dot(x[1:],y[:-1]))
+
+def inside(p,ring):
+    '''Return True if the point p is inside the closed ring (even-odd rule).'''
+    x1,y1=ring[:-1,0],ring[:-1,1]
+    x2,y2=ring[1:,0],ring[1:,1]
+    c=(y1 > p[1]) != (y2 > p[1])
+    xc=x1[c]+(p[1]-y1[c])*(x2[c]-x1[c])/(y2[c]-y1[c])
+    return (xc > p[0]).sum() % 2 == 1
+
+def orient_rings(rings):
+    '''Orient rings for a shapefile polygon: outer rings clockwise and holes
+    (rings nested in an odd number of other rings) counterclockwise.'''
+    out=[]
+    for k,r in enumerate(rings):
+        depth=sum([inside(r[0],s) for j,s in enumerate(rings) if j != k])
+        if (signed_area(r) > 0) == (depth % 2 == 0):
+            r=r[::-1]
+        out.append(r)
+    return out
+
+def write_shp(records,basename='fire'):
+    '''Write the records yielded by perimeters to a shapefile with its .prj and
+    .qix files.'''
+    w=shapefile.Writer(shapeType=shapefile.POLYGON)
+    w.field('TIME','C',19)
+    w.field('STEP','N',8,0)
+    w.field('AREA_M2','N',18,1)
+    w.field('PERIM_M','N',18,1)
+    w.field('GROWTH','N',18,4)
+    boxes=[]
+    for i,time,rings,r in records:
+        w.poly(parts=[p.tolist() for p in rings])
+        g=r['growth_m2_s']
+        if g is None:
+            g=''
+        w.record(time,i,r['area_m2'],r['perimeter_m'],g)
+        pts=np.concatenate(rings)
+        boxes.append((pts[:,0].min(),pts[:,1].min(),pts[:,0].max(),pts[:,1].max()))
+    w.save(basename)
+    f=open(basename+'.prj','w')
+    f.write(prjstr)
+    f.close()
+    write_qix(basename+'.qix',boxes)
+    return len(boxes)
+
+# fraction of a node's extent covered by each half when it is split, the
+# halves overlap like in shapelib so that small shapes on the split line still
+# go to a child node
+splitratio=0.55
 
+def split_bounds(b):
+    '''Split bounds (xmin,ymin,xmax,ymax) into two along the longer side.'''
+    xmin,ymin,xmax,ymax=b
+    if xmax-xmin > ymax-ymin:
+        d=(xmax-xmin)*splitratio
+        return ((xmin,ymin,xmin+d,ymax),(xmax-d,ymin,xmax,ymax))
+    d=(ymax-ymin)*splitratio
+    return ((xmin,ymin,xmax,ymin+d),(xmin,ymax-d,xmax,ymax))
 
-(fny,fnx)=lfn.shape
-nx=len(f.dimensions['west_east'])+1
-ny=len(f.dimensions['south_north'])+1
+def contains(b,box):
+    return b[0] <= box[0] and b[1] <= box[1] and b[2] >= box[2] and b[3] >= box[3]
 
-(srx,sry)=(fnx/nx,fny/ny)
+def write_qix(filename,boxes,maxdepth=None):
+    '''Write a quadtree index of shapes with the given bounding boxes in the
+    .qix format.  Each shape is stored in the deepest node that contains it,
+    empty nodes are left out.'''
+    if maxdepth is None:
+        # the default depth of shapelib
+        maxdepth=0
+        n=1
+        while n*4 < len(boxes):
+            maxdepth=maxdepth+1
+            n=n*2
+        maxdepth=max(maxdepth,1)
+    if boxes:
+        b=np.array(boxes)
+        bounds=(b[:,0].min(),b[:,1].min(),b[:,2].max(),b[:,3].max())
+    else:
+        bounds=(0.,0.,0.,0.)
+    # a node is [bounds,ids,children,quadrants]
+    root=[bounds,[],[],None]
+    for k,box in enumerate(boxes):
+        node=root
+        for depth in xrange(maxdepth-1):
+            if node[3] is None:
+                node[3]=[q for h in split_bounds(node[0]) for q in split_bounds(h)]
+            q=[q for q in node[3] if contains(q,box)]
+            if not q:
+                break
+            child=[c for c in node[2] if c[0] == q[0]]
+            if not child:
+                child=[[q[0],[],[],None]]
+                node[2].append(child[0])
+            node=child[0]
+        node[1].append(k)
 
-lfn=lfn[:-sry,:-srx]
+    def size(node):
+        # number of bytes of the node and its subtree
+        return 44+4*len(node[1])+sum([size(c) for c in node[2]])
 
-if (lfn > 0).all():
-    sys.exit(1)
+    def write(f,node):
+        f.write(struct.pack('<i4di',size(node)-44-4*len(node[1]),
+                            node[0][0],node[0][1],node[0][2],node[0][3],len(node[1])))
+        f.write(struct.pack('<%ii' % len(node[1]),*node[1]))
+        f.write(struct.pack('<i',len(node[2])))
+        for c in node[2]:
+            write(f,c)
 
-x=f.variables['FXLONG'][0,:-sry,:-srx]
-y=f.variables['FXLAT'][0,:-sry,:-srx]
-c=contour(x,y,lfn,[0]).collections[0]
+    f=open(filename,'wb')
+    # signature, little endian byte order, version 1
+    f.write('SQT'+struct.pack('<5B',1,1,0,0,0))
+    f.write(struct.pack('<2i',len(boxes),maxdepth))
+    write(f,root)
+    f.close()
 
-p=c.get_paths()
-poly=[]
-for i in p:
-    poly.extend(i.to_polygons())
-w=shapefile.Writer(shapeType=shapefile.POLYGON)
-w.poly(parts=poly)
-w.save('fire.shp')
+def main(file,nstep=None,basename='fire'):
+    if nstep is None:
+        steps=None
+    else:
+        steps=[nstep]
+    n=write_shp(perimeters(file,steps),basename)
+    print 'wrote %i perimeters to %s.shp' % (n,basename)
+    return n
 
-sys.exit(0)
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print "Takes a WRF-Fire output file and writes the fire perimeters to fire.shp."
+        print "usage: %s filename [step [basename]]" % sys.argv[0]
+        sys.exit(1)
+    n=None
+    if len(sys.argv) > 2:
+        n=int(sys.argv[2])
+    basename='fire'
+    if len(sys.argv) > 3:
+        basename=sys.argv[3]
+    if main(sys.argv[1],n,basename) == 0:
+        sys.exit(1)
+    sys.exit(0)
@@ -4,11 +4,14 @@
 Driver script for converting WRF-Fire netcdf output file to a sequence of kml
 for use with Google maps.
 
-Usage: nc2kml_sequence.py filename [var1 [var2 ...]]
+Usage: nc2kml_sequence.py [--resume] filename [var1 [var2 ...]]
+
+With --resume, the kml files and images recorded in kml/manifest.json by an
+interrupted run are reused and only the missing time steps are created.
 '''
 
-from ncEarth import ncWRFFire,ncWRFFireLog,ZeroArray
-from netCDF4 import Dataset
+from ncEarth import ncWRFFire,ncWRFFireLog,ZeroArray,ncManifest,jsonstats
+from ncEarth import Dataset
 import sys
 import os
 import shutil
@@ -30,6 +33,9 @@ def getTimes(file):
 
 if __name__ == '__main__':
     import sys
+    resume='--resume' in sys.argv
+    if resume:
+        sys.argv.remove('--resume')
     if len(sys.argv) < 2:
         print "Takes a WRF-Fire output file and writes fire.kmz."
         print "usage: %s filename"%sys.argv[0]
@@ -41,23 +47,36 @@ if __name__ == '__main__':
             vars=sys.argv[2:]
         #kmz=ncWRFFire_mov(filename)
         times=getTimes(filename)
+        if uselog(vars[0]):
+            foo=ncWRFFireLog
+        else:
+            foo=ncWRFFire
         n=0
-        try:
-            shutil.rmtree(kmlpath)
-        except Exception:
-            pass
-        os.mkdir(kmlpath)
+        if resume:
+            if not os.path.isdir(kmlpath):
+                os.mkdir(kmlpath)
+        else:
+            try:
+                shutil.rmtree(kmlpath)
+            except Exception:
+                pass
+            os.mkdir(kmlpath)
+        kml=foo(filename)
+        norm={'vars':list(vars),'stats':[jsonstats(kml.get_stats(v)) for v in vars]}
+        manifest=ncManifest(os.path.join(kmlpath,'manifest.json'),norm,kmlpath,resume)
         for time in times:
             n=n+1
             fname=os.path.join(kmlpath,'WRF-Fire_%03i.kml'%n)
+            if manifest.get(n)[0]:
+                print 'Reusing %s.' % fname
+                continue
             print 'Creating %s.' % fname
-            if uselog(vars[0]):
-                foo=ncWRFFireLog
-            else:
-                foo=ncWRFFire
 
             kml=foo(filename,istep=n-1)
+            imgfile=os.path.join(filepath,'img_%03i.png' % n)
             try:
-                kml.write_kml(vars,kmlfile=fname,imgfile=os.path.join(filepath,'img_%03i.png' % n),colorbar=False)
+                kml.write_kml(vars,kmlfile=fname,imgfile=imgfile,colorbar=False)
+                manifest.add(n,None,(os.path.basename(fname),imgfile))
             except ZeroArray:
-                pass
+                manifest.add(n,None)
+        manifest.close()
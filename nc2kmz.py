@@ -3,7 +3,12 @@
 '''
 Driver script for converting WRF-Fire netcdf output file to kmz.  
 
-Usage: nc2kmz.py filename [var1 [var2 ...]]
+Usage: nc2kmz.py [--resume] [--chunk nframes] filename [var1 [var2 ...]]
+
+With --resume, the images of an interrupted run are reused and only the
+missing frames are created.  With --chunk, fire_<var>.kml links to kml files
+of nframes frames each (loaded by Google Earth only for the current time
+window) instead of writing fire_<var>.kmz.
 '''
 
 from ncEarth import ncWRFFire_mov
@@ -17,6 +22,14 @@ def uselog(vname):
 
 if __name__ == '__main__':
     import sys
+    resume='--resume' in sys.argv
+    if resume:
+        sys.argv.remove('--resume')
+    chunk=None
+    if '--chunk' in sys.argv:
+        k=sys.argv.index('--chunk')
+        chunk=int(sys.argv[k+1])
+        del sys.argv[k:k+2]
     if len(sys.argv) < 2:
         print "Takes a WRF-Fire output file and writes fire.kmz."
         print "usage: %s filename"%sys.argv[0]
@@ -28,4 +41,4 @@ if __name__ == '__main__':
             vars=sys.argv[2:]
         kmz=ncWRFFire_mov(filename)
         for v in vars:
-            kmz.write(v,hsize=8,kmz='fire_'+v+'.kmz',logscale=uselog(v))
+            kmz.write(v,hsize=8,kmz='fire_'+v+'.kmz',logscale=uselog(v),resume=resume,chunk=chunk)
@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+
+'''
+Batch driver for converting many WRF-Fire output files (nested domains,
+ensemble members, ...) in one run.  All (file, product, frame) tasks are
+scheduled on a single shared pool of worker processes, interleaved between
+the files so that the workers stay busy until the last file is done.  Each
+output file gets its own output directory named after the file, so runs
+never overwrite each other's images.  Each frame is read and decoded once by
+the main process into shared memory (see ncShared), where it is used by all
+of the tasks that need it without copying.  Completed frames are recorded in a
+manifest in each output directory, with resume=True (--resume) an interrupted
+batch only creates the frames that are missing.  With store=True (--store) the
+overlay and colorbar images are written into a single SQLite file per run,
+<outdir>/<run>/fire.mbtiles (see ncTiles), instead of loose png files and a kmz,
+the kmz is then built from the store with ncTiles.py.  With chunk=n (--chunk n)
+the overlay and perimeter products are written as a root kml file linking to
+kml files of n time steps each (see ncEarth.ncChunkedKml), which are written as
+soon as their frames are done.  With cache='npy' or 'npz' (--cache) the arrays of
+the overlay images are also saved quantized in <outdir>/<run>/frames, from which
+ncFrames.py writes restyled kmz files without reading the WRF output again.
+
+Products:
+  overlay   : animated kmz of each variable      <outdir>/<run>/fire_<var>.kmz
+  sequence  : one kml file per time step         <outdir>/<run>/sequence_<var>/
+  perimeter : fire perimeter computed from LFN   <outdir>/<run>/fire_perimeter.kml
+              and its statistics                 <outdir>/<run>/fire_perimeter.csv,.json
+  colorbar  : colorbar image of each variable    <outdir>/<run>/files/colorbar_<var>.png
+
+Usage: ncBatch.py [options] wrfout [wrfout ...]
+
+or
+
+import ncBatch
+ncBatch.convert(['wrfout_d01','wrfout_d02'],vnames=('FGRNHFX',),
+                products=('overlay','perimeter'),outdir='out',crop='run')
+'''
+
+import ncEarth
+from ncEarth import ncWRFFire,ncWRFFireLog,ZeroArray,uselog,write_kmz,jsonstats,ncManifest,ncChunkedKml
+import lfn2kml
+import ncShared
+import ncTiles
+import ncFrames
+import numpy as np
+import multiprocessing
+import Queue
+import itertools
+from collections import deque
+import os,sys
+
+products=('overlay','sequence','perimeter','colorbar')
+vstr='files/%s_%05i.png'         # overlay images relative to the run directory
+seqstr='WRF-Fire_%03i.kml'       # sequence kml files relative to the sequence directory
+seqimgstr='files/img_%03i.png'   # sequence images relative to the sequence directory
+framedir='frames'                # frame cache relative to the run directory
+
+def runnames(filenames):
+    '''Return a unique output directory name for each input file.  The base name
+    is used unless it is shared with another file (ensemble members), then the
+    whole path is encoded in the name.'''
+    base=[os.path.basename(f) for f in filenames]
+    names=[]
+    for f,b in zip(filenames,base):
+        if base.count(b) > 1:
+            b=os.path.normpath(f).strip(os.sep).replace(os.sep,'_')
+        names.append(b)
+    if len(set(names)) < len(names):
+        raise Exception("Input files are not unique.")
+    return dict(zip(filenames,names))
+
+def ntimes(filename):
+    f=ncEarth.Dataset(filename,'r')
+    n=f.variables['Times'].shape[0]
+    f.close()
+    return n
+
+def frame(filename,vname,istep,opts,stats,spec=None):
+    '''Create the ncEarth object for one time step of a variable, using the shared
+    statistics computed by a stats task and the array decoded into shared memory
+    by the main process.'''
+    if uselog(vname):
+        kml=ncWRFFireLog(filename,istep=istep,**opts)
+    else:
+        kml=ncWRFFire(filename,istep=istep,**opts)
+    if stats is not None:
+        kml.set_stats(vname,stats)
+    if spec is not None:
+        kml.set_array(vname,ncShared.get_frame(spec))
+    return kml
+
+def read_frame(key,opts):
+    '''Read the image array of a frame (filename,vname,istep), see ncEarth.get_frame.'''
+    filename,vname,istep=key
+    return ncWRFFire(filename,istep=istep,**opts).get_frame(vname)
+
+def task_stats(filename,vname,opts):
+    return frame(filename,vname,0,opts,None).get_stats(vname)
+
+def task_overlay(filename,vname,istep,path,cache,opts,stats,spec=None):
+    kml=frame(filename,vname,istep,opts,stats,spec)
+    kml.frames=cache
+    img=vstr % (vname,istep)
+    try:
+        if path is None:
+            # return the image to the main process for the tile store
+            return kml.image2kmlData(vname,img)
+        return kml.image2kml(vname,os.path.join(path,img),img)
+    except ZeroArray:
+        return None
+
+def task_sequence(filename,vname,istep,path,opts,stats,spec=None):
+    kml=frame(filename,vname,istep,opts,stats,spec)
+    kmlfile=os.path.join(path,seqstr % (istep+1))
+    try:
+        kml.write_kml((vname,),kmlfile=kmlfile,imgfile=seqimgstr % (istep+1),colorbar=False)
+    except ZeroArray:
+        return None
+    return True
+
+def task_colorbar(filename,vname,path,opts,stats,spec=None):
+    kml=frame(filename,vname,0,opts,stats)
+    img='files/colorbar_%s.png' % vname
+    if path is None:
+        return kml.colorbar2kmlData(vname,img)
+    return kml.colorbar2kml(vname,os.path.join(path,img),img)
+
+def task_perimeter(filename,istep,spec=None):
+    fire=None
+    if spec is not None:
+        # the shared LFN frame is in image orientation without the extra row
+        # and column of the subgrid
+        lfn=ncShared.get_frame(spec)[::-1]
+        ny,nx=lfn.shape
+        x=ncEarth.geometry[(filename,'FXLONG')][:ny,:nx]
+        y=ncEarth.geometry[(filename,'FXLAT')][:ny,:nx]
+        fire=(lfn,x,y)
+    # the placemark is rendered in the main process once the previous time
+    # step is done, with the growth rate of the burned area
+    return lfn2kml.perimeterdata(filename,istep,fire)
+
+tasks={'stats':task_stats,
+       'overlay':task_overlay,
+       'sequence':task_sequence,
+       'colorbar':task_colorbar,
+       'perimeter':task_perimeter}
+
+def run_task(task):
+    '''Execute a task (job,key,kind,args...) in a worker process and return it
+    along with the result and the traceback of an error.  The key identifies the
+    task within its job (the time step or 'colorbar').'''
+    try:
+        return (task,tasks[task[2]](*task[3:]),None)
+    except Exception:
+        import traceback
+        return (task,None,traceback.format_exc())
+
+def jobpath(job,path):
+    '''Return the directory that the files of a job are relative to.'''
+    if job[1] == 'sequence':
+        return os.path.join(path,'sequence_%s' % job[2])
+    return path
+
+def taskfiles(task,result):
+    '''Return the files written by a task relative to its job directory.'''
+    key,kind=task[1],task[2]
+    if result is None:
+        return ()
+    elif kind == 'overlay':
+        return (vstr % (task[4],key),)+cachefiles(task,result)
+    elif kind == 'colorbar':
+        return ('files/colorbar_%s.png' % task[4],)
+    elif kind == 'sequence':
+        return (seqstr % (key+1),seqimgstr % (key+1))
+    return ()
+
+def cachefiles(task,result):
+    '''Return the frame cache files written by an overlay task relative to its
+    job directory.'''
+    if result is None or task[2] != 'overlay' or task[7] is None:
+        return ()
+    return tuple([os.path.join(framedir,f) for f in task[7].framefiles(task[4],task[1])])
+
+def tilestep(key):
+    '''Return the timestep a task's image is stored at in a tile store.'''
+    if key == 'colorbar':
+        return ncTiles.colorbar
+    return key
+
+def interleave(lists):
+    '''Merge a list of lists round-robin.'''
+    for t in itertools.izip_longest(*lists):
+        for i in t:
+            if i is not None:
+                yield i
+
+def finalize(job,path,results,store=None,chunks=None):
+    '''Write the output of a job after all of its tasks are done.  Overlays written
+    to a tile store are only committed, chunked kml is already written except
+    for incomplete buckets.'''
+    filename,product,vname=job
+    if store is not None and product in ('overlay','colorbar'):
+        store.commit()
+        return
+    if product == 'perimeter':
+        # the results are (placemark,record) with the growth rates, see convert
+        steps=sorted(results.keys())
+        lfn2kml.writestats([results[k][1] for k in steps],os.path.join(path,'fire_perimeter'))
+        results=dict([(k,results[k][0]) for k in steps])
+    if chunks is not None:
+        chunks.close()
+        return
+    frames=sorted([k for k in results.keys() if k != 'colorbar' and results[k] is not None])
+    content=[results[k] for k in frames]
+    if product == 'overlay':
+        imgs=[vstr % (vname,k) for k in frames]
+        if results.get('colorbar') is not None:
+            content.insert(0,results['colorbar'])
+            imgs.insert(0,'files/colorbar_%s.png' % vname)
+        kml=ncWRFFire.kmlstr % {'content':'\n'.join(content),'prog':ncWRFFire.progname}
+        write_kmz(os.path.join(path,'fire_%s.kmz' % vname),kml,imgs,path)
+    elif product == 'perimeter':
+        lfn2kml.writekml(content,os.path.join(path,'fire_perimeter.kml'))
+
+def convert(filenames,vnames=('FGRNHFX',),products=products,outdir='.',nproc=None,resume=False,
+            shared=True,nslots=None,store=False,chunk=None,cache=None,**opts):
+    '''Convert a list of WRF output files.
+       filenames : list of WRF output files
+       vnames : variables for the overlay, sequence and colorbar products
+       products : list of products to create (see module documentation)
+       outdir : directory containing one output directory per file
+       nproc : number of worker processes (default is the number of cpus)
+       resume : reuse the frames of a previous run recorded in the manifests
+       shared : decode each frame once in this process and pass it to the workers
+                in shared memory, otherwise every task reads the file itself
+       nslots : number of frames held in shared memory (default 2*nproc)
+       store : write overlay and colorbar images to <run>/fire.mbtiles
+       chunk : write overlays and perimeters as kml files of chunk time steps
+               linked from <run>/fire_<var>.kml and <run>/fire_perimeter.kml
+       cache : save the arrays of the overlay images in <run>/frames as 'npy'
+               (memory mapped) or 'npz' (compressed) files, see ncFrames
+       other keyword arguments (crop, npixels, level, height, ...) are passed to ncWRFFire'''
+    for p in products:
+        if p not in tasks or p == 'stats':
+            raise ValueError("Unknown product %s" % p)
+    if store and chunk:
+        raise ValueError("Chunked kml cannot refer to images in a tile store.")
+    runs=runnames(filenames)
+    paths={}
+    nsteps={}
+    for f in filenames:
+        paths[f]=os.path.join(outdir,runs[f])
+        nsteps[f]=ntimes(f)
+        for d in ['files']+[os.path.join('sequence_%s' % v,'files') for v in vnames \
+                            if 'sequence' in products]:
+            d=os.path.join(paths[f],d)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+    stores={}
+    if store:
+        for f in filenames:
+            stores[f]=ncTiles.ncTileStore(os.path.join(paths[f],'fire.mbtiles'),resume=resume)
+
+    if nproc is None:
+        nproc=multiprocessing.cpu_count()
+
+    # create the task groups of each file, the tasks of a group use the same
+    # frame (filename,vname,istep) or None
+    lists=[]
+    jobs={}
+    imgproducts=[p for p in products if p != 'perimeter']
+    for f in filenames:
+        l=[]
+        path=paths[f]
+        if store:
+            # images of overlay and colorbar tasks are returned to this process
+            path=None
+        framecache=None
+        if cache:
+            framecache=ncFrames.ncFrameCache(os.path.join(paths[f],framedir),compress=cache == 'npz')
+        for v in vnames:
+            if 'colorbar' in products:
+                if 'overlay' in products:
+                    job=(f,'overlay',v)
+                else:
+                    job=(f,'colorbar',v)
+                l.append([None,[(job,'colorbar','colorbar',f,v,path,opts)]])
+        for i in xrange(nsteps[f]):
+            groups={}
+            for v in vnames:
+                t=[]
+                if 'overlay' in products:
+                    t.append(((f,'overlay',v),i,'overlay',f,v,i,path,framecache,opts))
+                if 'sequence' in products:
+                    t.append(((f,'sequence',v),i,'sequence',f,v,i,
+                              os.path.join(paths[f],'sequence_%s' % v),opts))
+                if t:
+                    groups[v]=[(f,v,i),t]
+                    l.append(groups[v])
+            if 'perimeter' in products:
+                t=((f,'perimeter',None),i,'perimeter',f,i)
+                if groups.has_key('LFN'):
+                    groups['LFN'][1].append(t)
+                else:
+                    l.append([(f,'LFN',i),[t]])
+        for key,t in l:
+            for task in t:
+                jobs.setdefault(task[0],[]).append(task)
+        lists.append(l)
+
+    # allocate the shared memory before the workers are forked
+    ring=None
+    geom={}
+    if shared:
+        size=0
+        for f in filenames:
+            g=ncEarth.Dataset(f,'r')
+            for v in set([key[1] for l in lists for key,t in l if key is not None]):
+                v=ncEarth.source_name(v)
+                if g.variables.has_key(v):
+                    size=max(size,int(np.prod(g.variables[v].shape[-2:])))
+            g.close()
+        if size > 0:
+            ring=ncShared.ncFrameRing(nslots or 2*nproc,size)
+        geom=ncShared.share_geometry(filenames)
+    pool=multiprocessing.Pool(nproc,initializer=ncShared.attach,initargs=(ring,geom))
+
+    # compute color limits (and crop windows) once per variable
+    stats={}
+    if imgproducts:
+        t=[(None,(f,v),'stats',f,v,opts) for f in filenames for v in vnames]
+        for task,result,error in pool.imap_unordered(run_task,t):
+            if error is not None:
+                pool.terminate()
+                raise Exception(error)
+            stats[task[1]]=result
+    for l in lists:
+        for group in l:
+            group[1]=[task+(stats.get((task[3],task[4])),) if task[2] != 'perimeter' else task \
+                      for task in group[1]]
+
+    # open the manifest of each job, frames recorded with the same
+    # normalization and unchanged files are not created again
+    manifests={}
+    results=dict([(job,{}) for job in jobs])
+    for job in jobs:
+        f,product,v=job
+        norm={'product':product,'vname':v}
+        if product != 'perimeter':
+            norm['options']=opts
+            norm['stats']=jsonstats(stats[(f,v)])
+        if product == 'perimeter':
+            # frames are recorded as the result of lfn2kml.perimeterdata
+            norm['records']='perimeterdata'
+        if product in ('overlay','colorbar'):
+            norm['store']=bool(store)
+        if product == 'overlay':
+            norm['cache']=cache
+        if v is None:
+            name='manifest_%s.json' % product
+        else:
+            name='manifest_%s_%s.json' % (product,v)
+        manifests[job]=ncManifest(os.path.join(paths[f],name),norm,jobpath(job,paths[f]),resume)
+
+    # the chunked kml of each job, frames are added as they are done
+    chunks={}
+    if chunk:
+        for job in jobs:
+            f,product,v=job
+            if product == 'overlay':
+                kmlfile=os.path.join(paths[f],'fire_%s.kml' % v)
+                wrap=lambda content: ncWRFFire.kmlstr % {'content':content,'prog':ncWRFFire.progname}
+            elif product == 'perimeter':
+                kmlfile=os.path.join(paths[f],'fire_perimeter.kml')
+                wrap=lambda content: lfn2kml.kmlstr % content
+            else:
+                continue
+            chunks[job]=ncChunkedKml(kmlfile,ncEarth.get_times(f),ncWRFFire(f).get_bounds(),wrap,chunk)
+
+    # perimeter results wait until the previous time step of their job is
+    # done, then the placemark is rendered with the growth rate since it
+    waiting=dict([(job,{}) for job in jobs if job[1] == 'perimeter'])
+    nextstep=dict([(job,0) for job in waiting])
+    prevrecord={}
+
+    def collect(job,key,result):
+        if not waiting.has_key(job):
+            emit(job,key,result)
+            return
+        waiting[job][key]=result
+        while waiting[job].has_key(nextstep[job]):
+            k=nextstep[job]
+            geometry,tstr,record=waiting[job].pop(k)
+            p,record=lfn2kml.placemark(geometry,tstr,record,prevrecord.get(job))
+            prevrecord[job]=record
+            nextstep[job]=k+1
+            emit(job,k,(p,record))
+
+    def emit(job,key,result):
+        results[job][key]=result
+        if job[1] == 'perimeter':
+            result=result[0]
+        if chunks.has_key(job):
+            if key == 'colorbar':
+                chunks[job].set_static(result or '')
+            else:
+                chunks[job].add(key,result)
+
+    for l in lists:
+        for group in l[:]:
+            for task in group[1][:]:
+                done,result=manifests[task[0]].get(task[1])
+                if done and store and result is not None and task[2] in ('overlay','colorbar'):
+                    done=stores[task[3]].has(task[4],tilestep(task[1]))
+                if done:
+                    collect(task[0],task[1],result)
+                    group[1].remove(task)
+            if not group[1]:
+                l.remove(group)
+
+    # run all tasks on the pool, finishing each job as soon as it is complete
+    remaining=dict([(job,0) for job in jobs])
+    for l in lists:
+        for key,t in l:
+            for task in t:
+                remaining[task[0]]=remaining[task[0]]+1
+    for job in jobs:
+        if remaining[job] == 0:
+            finalize(job,paths[job[0]],results.pop(job),stores.get(job[0]),chunks.get(job))
+    ntasks=sum(remaining.values())
+    pending=deque(interleave(lists))
+    done=Queue.Queue()
+    running=0
+    n=0
+    while pending or running:
+        # decode frames while there are free slots and submit their tasks
+        while pending and (ring is None or ring.free or pending[0][0] is None):
+            key,t=pending.popleft()
+            spec=None
+            if ring is not None and key is not None:
+                spec=ring.put(read_frame(key,opts),len(t))
+            for task in t:
+                pool.apply_async(run_task,(task+(spec,),),callback=done.put)
+                running=running+1
+        task,result,error=done.get()
+        running=running-1
+        if error is not None:
+            pool.terminate()
+            raise Exception(error)
+        if task[-1] is not None:
+            ring.release(task[-1][0])
+        job=task[0]
+        n=n+1
+        if store and result is not None and task[2] in ('overlay','colorbar'):
+            result,png=result
+            stores[task[3]].put(task[4],tilestep(task[1]),png,result,taskfiles(task,result)[0])
+            manifests[job].add(task[1],result,cachefiles(task,result))
+        else:
+            manifests[job].add(task[1],result,taskfiles(task,result))
+        collect(job,task[1],result)
+        remaining[job]=remaining[job]-1
+        print 'finished task %i of %i: %s %s %s %s' % (n,ntasks,runs[job[0]],task[2],job[2] or '',task[1])
+        if remaining[job] == 0:
+            finalize(job,paths[job[0]],results.pop(job),stores.get(job[0]),chunks.get(job))
+    pool.close()
+    pool.join()
+    for job in manifests:
+        manifests[job].close()
+    for f in stores:
+        stores[f].close()
+
+if __name__ == '__main__':
+    import argparse
+    parser=argparse.ArgumentParser(description='Convert many WRF-Fire output files on a shared worker pool.')
+    parser.add_argument('filenames',nargs='+',metavar='wrfout')
+    parser.add_argument('-v','--var',action='append',dest='vnames',
+                        help='variable to visualize, may be repeated (default FGRNHFX)')
+    parser.add_argument('-p','--products',default='overlay,colorbar',
+                        help='comma separated list of %s (default overlay,colorbar)' % ','.join(products))
+    parser.add_argument('-o','--outdir',default='.',help='output directory')
+    parser.add_argument('-j','--nproc',type=int,default=None,help='number of worker processes')
+    parser.add_argument('--crop',choices=('frame','run'),default=None,help='crop images to the active area')
+    parser.add_argument('--npixels',type=int,default=None,help='target number of pixels per image')
+    parser.add_argument('--level',type=int,default=None,help='model level of 4D variables')
+    parser.add_argument('--height',type=float,default=None,
+                        help='interpolate 4D variables to a height above ground (m)')
+    parser.add_argument('--pressure',type=float,default=None,
+                        help='interpolate 4D variables to a pressure level (Pa)')
+    parser.add_argument('--resume',action='store_true',help='only create frames missing from a previous run')
+    parser.add_argument('--no-shared',action='store_false',dest='shared',
+                        help='read frames in the workers instead of sharing them')
+    parser.add_argument('--store',action='store_true',
+                        help='write overlay images to <run>/fire.mbtiles instead of a kmz')
+    parser.add_argument('--cache',nargs='?',const='npy',choices=('npy','npz'),
+                        help='save quantized overlay arrays in <run>/frames for ncFrames.py')
+    parser.add_argument('--backend',default='auto',choices=['auto']+sorted(ncEarth.backends.keys()),
+                        help='NetCDF backend (default: memory map classic format files)')
+    parser.add_argument('--chunk',type=int,metavar='N',
+                        help='write overlays and perimeters as kml files of N time steps')
+    args=parser.parse_args()
+    ncEarth.set_backend(args.backend)
+    opts={}
+    for k in ('crop','npixels','level','height','pressure'):
+        if getattr(args,k) is not None:
+            opts[k]=getattr(args,k)
+    convert(args.filenames,vnames=args.vnames or ('FGRNHFX',),
+            products=args.products.split(','),outdir=args.outdir,nproc=args.nproc,
+            resume=args.resume,shared=args.shared,store=args.store,chunk=args.chunk,
+            cache=args.cache,**opts)
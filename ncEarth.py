@@ -27,29 +27,25 @@ kmz.write_preload('FGRNHFX')
 
 Modified by Lin Zhang
 Date: Dec 20, 2010
+
+matplotlib, the NetCDF backend and zipfile are only imported by the code paths
+that need them.  NetCDF classic and 64-bit offset files are memory mapped by
+default (see set_backend and ncMmap).  Images rendered at a fixed pixel size (npixels or nbytes) are
+colored and encoded with numpy alone, so exporting overlays without a colorbar
+does not import matplotlib at all.
 '''
 
 
-import matplotlib
-try:
-    matplotlib.use('Agg')
-except:
-    pass
-from matplotlib import pylab
-from matplotlib.colorbar import ColorbarBase
-from matplotlib.colors import LogNorm,Normalize
-from matplotlib.ticker import LogFormatter
 import numpy as np
-try:
-    from netCDF4 import Dataset
-except:
-    from Scientific.IO.NetCDF import NetCDFFile as Dataset
-import cStringIO
 from datetime import datetime
-import zipfile
 import shutil,os
+import hashlib
+import json
 import warnings
 import threading
+import Queue
+import traceback
+from collections import OrderedDict
 
 try:
     ncpu=max(1,os.sysconf('SC_NPROCESSORS_ONLN'))
@@ -58,16 +54,90 @@ except:
 
 warnings.simplefilter('ignore')
 
+def get_pylab():
+    '''Import matplotlib with the non-interactive Agg backend on first use.'''
+    import matplotlib
+    try:
+        matplotlib.use('Agg')
+    except:
+        pass
+    from matplotlib import pylab
+    return pylab
+
+def open_netCDF4(filename,mode='r'):
+    from netCDF4 import Dataset as ncDataset
+    return ncDataset(filename,mode)
+
+def open_Scientific(filename,mode='r'):
+    from Scientific.IO.NetCDF import NetCDFFile as ncDataset
+    return ncDataset(filename,mode)
+
+def open_mmap(filename,mode='r'):
+    import ncMmap
+    return ncMmap.Dataset(filename,mode)
+
+# NetCDF backends by name, each a function (filename,mode) returning an object
+# with the interface of netCDF4.Dataset
+backends={'netCDF4':open_netCDF4,
+          'Scientific':open_Scientific,
+          'mmap':open_mmap}
+
+global backend
+backend='auto'
+
+def set_backend(name):
+    '''Select the NetCDF backend used by Dataset, one of the keys of backends or
+    'auto' (the default) for memory mapping of classic and 64-bit offset files
+    when reading, and netCDF4 (or Scientific if netCDF4 is not installed)
+    otherwise.'''
+    global backend
+    if name != 'auto' and not backends.has_key(name):
+        raise ValueError("Unknown NetCDF backend %s" % name)
+    backend=name
+
+def Dataset(filename,mode='r'):
+    '''Open a NetCDF file with the backend selected by set_backend.'''
+    if backend != 'auto':
+        return backends[backend](filename,mode)
+    if mode == 'r':
+        import ncMmap
+        if ncMmap.isclassic(filename):
+            return open_mmap(filename,mode)
+    try:
+        return open_netCDF4(filename,mode)
+    except ImportError:
+        return open_Scientific(filename,mode)
+
+# segment data of matplotlib's jet colormap, used to color images without matplotlib
+jetdata={'red':((0.,0.,0.),(0.35,0.,0.),(0.66,1.,1.),(0.89,1.,1.),(1.,0.5,0.5)),
+         'green':((0.,0.,0.),(0.125,0.,0.),(0.375,1.,1.),(0.64,1.,1.),(0.91,0.,0.),(1.,0.,0.)),
+         'blue':((0.,0.5,0.5),(0.11,1.,1.),(0.34,1.,1.),(0.65,0.,0.),(1.,0.,0.))}
+ncolors=256
+
 global dlock
 global lock
 global queue
 global minmax
 global ncfile
+global cropbox
+global luts
+global geometry
+global kernels
+global vweights
+global slices
 minmax={}
+cropbox={}
+luts={}
+geometry={}  # coordinate arrays shared by another process, keyed by (filename,name)
 lock=threading.RLock()
 dlock=threading.RLock()
 queue=threading.Semaphore(ncpu)
 ncfile={}
+kernels=threading.local()  # the frame kernel of each thread
+vweights=OrderedDict()     # vertical interpolation weights, see ncWRFFireBase.get_weights
+maxweights=16              # number of time steps and levels kept in vweights
+slices=OrderedDict()       # source slices and derived fields, see ncWRFFireBase.get_slice
+maxslices=2**27            # bytes kept in slices
 
 class ZeroArray(Exception):
     pass
@@ -78,6 +148,11 @@ class ncEarth(object):
     
     kmlname='ncEarth.kml'  # default name for kml output file
     progname='baseClass'   # string describing the model (overload in subclass)
+    pool='mean'            # block reduction used to downsample images ('mean' or 'max')
+    pngbytes=0.5           # estimated size of a compressed png pixel in bytes
+    logscale=False         # color scale of images rendered with numpy
+    istep=0                # time step of the images
+    frames=None            # ncFrames.ncFrameCache the arrays of overlay images are saved in
     
     # base kml file format string
     # creates a folder containing all images
@@ -157,60 +232,209 @@ class ncEarth(object):
     beginstr='<begin>%s</begin>'
     endstr='<end>%s</end>'
     
-    def __init__(self,filename,hsize=5):
+    def __init__(self,filename,hsize=5,crop=None,margin=2,threshold=0.,
+                 npixels=None,nbytes=None,pool=None):
         '''Class constructor:
            filename : string NetCDF file to read
-           hsize : optional, width of output images in inches'''
+           hsize : optional, width of output images in inches
+           crop : optional, crop images to the active area of the variable,
+                  'frame' computes the window for every image, 'run' uses the
+                  union over all time slices, None disables cropping
+           margin : optional, number of cells to pad the cropped window with
+           threshold : optional, cells with absolute value above threshold are active
+           npixels : optional, target number of pixels of output images, large arrays
+                     are downsampled by blocks and images are rendered one pixel per
+                     cell instead of at hsize inches
+           nbytes : optional, target file size of output images (overrides npixels)
+           pool : optional, block reduction used for downsampling, 'mean' or 'max'
+                  (default is the class attribute pool)'''
         global ncfile
         global lock
         with lock:
             if not ncfile.has_key(filename):
                 ncfile[filename]=Dataset(filename,'r')
         self.f=ncfile[filename]
+        self.filename=filename
         self.hsize=hsize
+        self.crop=crop
+        self.margin=margin
+        self.threshold=threshold
+        self.window=None
+        self.arrays={}
+        self.npixels=npixels
+        self.nbytes=nbytes
+        if pool is not None:
+            self.pool=pool
 
     def get_minmax(self,vname):
         global minmax
         with lock:
-            if minmax.has_key(vname):
-                mm=minmax[vname]
+            key=self.varkey(vname)
+            if minmax.has_key(key):
+                mm=minmax[key]
             else:
                 mm=self.compute_minmax(vname)
-                minmax[vname]=mm
+                minmax[key]=mm
         return mm
 
     def compute_minmax(self,vname):
-        v=self.f.variables[vname][:]
+        v=self.get_series(vname)
         return (v.min(),v.max())
+
+    def get_series(self,vname):
+        '''Return all values of a variable shown in images, used for the color
+        limits and crop windows of a run.'''
+        return self.f.variables[vname][:]
+
+    def varkey(self,vname):
+        '''Return the key of a variable in the shared statistics.'''
+        return (self.filename,vname)
+
+    def get_stats(self,vname):
+        '''Return the statistics of a variable shared by all images (color limits
+        and the crop window of the run), so they can be computed once and handed
+        to other processes with set_stats.'''
+        box=None
+        if self.crop == 'run':
+            box=self.get_cropbox(vname)
+        return (self.get_minmax(vname),box)
+
+    def set_stats(self,vname,stats):
+        '''Use statistics returned by get_stats instead of computing them.'''
+        global minmax
+        global cropbox
+        mm,box=stats
+        with lock:
+            minmax[self.varkey(vname)]=mm
+            if self.crop == 'run':
+                cropbox[self.varkey(vname)+(self.margin,self.threshold)]=box
     
     def get_bounds(self):
         '''Return the latitude and longitude bounds of the image.  Must be provided
         by the subclass.'''
         raise Exception("Non-implemented base class method.")
     
+    def orient(self,vname,v):
+        '''Transform a 2D array read from the file into image orientation (top
+        to bottom).'''
+        return np.flipud(v)
+
     def get_array(self,vname):
         '''Return a given array from the output file.  Must be returned as a
         2D array with top to bottom orientation (like an image).'''
+        if self.arrays.has_key(vname):
+            return self.arrays[vname]
         v=self.f.variables[vname]
-        v=pylab.flipud(v)
+        v=self.orient(vname,v)
         return v
+
+    def get_frame(self,vname):
+        '''Return the array of get_array before it is multiplied by the factor of
+        get_scale.  Images are colored from it by ncFrameKernel, which applies the
+        factor in place.'''
+        return self.get_array(vname)
+
+    def get_scale(self,vname):
+        '''Return the factor that the array of get_frame is multiplied by.'''
+        return 1.
+
+    def set_array(self,vname,v):
+        '''Use v as the result of get_frame for a variable instead of reading the
+        file, for example an array decoded by another process.'''
+        self.arrays[vname]=v
+    
+    def get_cropbox(self,vname):
+        '''Return the crop window of a variable over all time slices.'''
+        global cropbox
+        key=self.varkey(vname)+(self.margin,self.threshold)
+        with lock:
+            if cropbox.has_key(key):
+                w=cropbox[key]
+            else:
+                w=self.compute_cropbox(vname)
+                cropbox[key]=w
+        return w
+
+    def compute_cropbox(self,vname):
+        m=self.active(self.get_series(vname))
+        while m.ndim > 2:
+            m=m.any(axis=0)
+        return active_window(self.orient(vname,m),self.margin)
+
+    def active(self,v,scale=1.):
+        '''Return a boolean mask of the cells considered active for cropping, of
+        the values of v multiplied by scale.'''
+        return np.abs(np.ma.filled(v,0.)) > self.threshold/abs(scale)
+
+    def get_window(self,vname,v,scale=1.):
+        '''Return the window (i1,i2,j1,j2) of the image array v (multiplied by
+        scale) to render, or None for the full array.'''
+        if self.crop == 'run':
+            return self.get_cropbox(vname)
+        elif self.crop == 'frame':
+            return active_window(self.active(v,scale),self.margin)
+        else:
+            return None
+
+    def crop_array(self,vname,v,scale=1.):
+        '''Restrict an image array to its crop window, the window is saved and
+        used by get_kml_dict to georeference the image.'''
+        w=self.get_window(vname,v,scale)
+        if w is None:
+            self.window=None
+            return v
+        i1,i2,j1,j2=w
+        self.window=(i1,i2,j1,j2,v.shape[0],v.shape[1])
+        return v[i1:i2,j1:j2]
+
     
     def view_function(self,v):
         '''Any function applied to the image data before plotting.  For example,
         to show the color on a log scale.'''
         return v
     
-    def get_image(self,v,min,max):
-        '''Create an image from a given data.  Returns a png image as a string.'''
-                
+    def get_factor(self,shape):
+        '''Return the block size used to downsample an array of the given shape
+        to the requested output resolution, or None to render at hsize inches.'''
+        npixels=self.npixels
+        if self.nbytes is not None:
+            npixels=self.nbytes/self.pngbytes
+        if npixels is None:
+            return None
+        return max(1,int(np.ceil(np.sqrt(float(shape[0]*shape[1])/npixels))))
+
+    def reduce_array(self,v):
+        '''Return an array downsampled by blocks to the resolution of the image, or
+        None if images are rendered with matplotlib at hsize inches.'''
+        factor=self.get_factor(v.shape)
+        if factor is None:
+            return None
+        return block_reduce(v,factor,self.pool)
+
+    def get_image(self,v,min,max,reduced=None,scale=1.):
+        '''Create an image from a given data.  Returns a png image as a string.
+        The result of reduce_array can be given if it was already computed, the
+        data is multiplied by scale while it is colored.  Both renderings color
+        the data with ncFrameKernel, matplotlib only scales the RGBA image to
+        hsize inches.'''
+        
+        if reduced is None:
+            reduced=self.reduce_array(v)
+        if reduced is not None:
+            # render one pixel per (downsampled) cell directly from numpy
+            rgba=get_kernel().colorize(self.view_function(reduced),min,max,get_lut('jet'),self.logscale,scale)
+            return png_image(rgba)
+        
+        rgba=get_kernel().colorize(self.view_function(v),min,max,get_lut('jet'),self.logscale,scale)
+        import cStringIO
+        pylab=get_pylab()
+        
         # kludge to get the image to have no border
         fig=pylab.figure(figsize=(self.hsize,self.hsize*float(v.shape[0])/v.shape[1]))
         ax=fig.add_axes([0,0,1,1])
         
-        cmap=pylab.cm.jet
-        cmap.set_bad('w',0.)
-        norm=self.get_norm(min,max)
-        ax.imshow(self.view_function(v),cmap=cmap,norm=norm)
+        # masked cells are transparent in the lookup table
+        ax.imshow(rgba)
         ax.axis('off')
         self.process_image()
         
@@ -224,29 +448,12 @@ class ncEarth(object):
         im.close()
         return s
 
-    def get_colorbar(self,title,label,min,max):
+    def get_colorbar(self,title,label,min,max,cmap=None):
         '''Create a colorbar from given data.  Returns a png image as a string.'''
-        
-        fig=pylab.figure(figsize=(2,5))
-        ax=fig.add_axes([0.35,0.03,0.1,0.9])
-        norm=self.get_norm(min,max)
-        formatter=self.get_formatter()
-        if formatter:
-            cb1 = ColorbarBase(ax,norm=norm,format=formatter,spacing='proportional',orientation='vertical')
-        else:
-            cb1 = ColorbarBase(ax,norm=norm,spacing='proportional',orientation='vertical')
-        cb1.set_label(label,color='1')
-        ax.set_title(title,color='1')
-        for tl in ax.get_yticklabels():
-            tl.set_color('1')
-        im=cStringIO.StringIO()
-        fig.savefig(im,dpi=300,format='png',transparent=True)
-        pylab.close(fig)
-        s=im.getvalue()
-        im.close()
-        return s
+        return colorbar_image(title,label,self.get_norm(min,max),self.get_formatter(),cmap)
 
     def get_norm(self,min,max):
+        from matplotlib.colors import Normalize
         norm=Normalize(min,max)
         return norm
 
@@ -254,7 +461,8 @@ class ncEarth(object):
         return None
     
     def process_image(self):
-        '''Do anything to the current figure window before saving it as an image.'''
+        '''Do anything to the current figure window before saving it as an image
+        (only called when images are rendered with matplotlib).'''
         pass
     
     def get_kml_dict(self,name,filename,alpha=143):
@@ -262,6 +470,12 @@ class ncEarth(object):
         portion of the kml file'''
         
         lon1,lon2,lat1,lat2=self.get_bounds()
+        if self.window is not None:
+            # image rows run from north to south, columns from west to east
+            i1,i2,j1,j2,ny,nx=self.window
+            dlon=(lon2-lon1)/nx
+            dlat=(lat2-lat1)/ny
+            lon1,lon2,lat1,lat2=lon1+j1*dlon,lon1+j2*dlon,lat2-i2*dlat,lat2-i1*dlat
         d={'lat1':lat1,'lat2':lat2,'lon1':lon1,'lon2':lon2, \
            'name':name,'filename':filename,'time':self.get_time(),'alpha':alpha}
         return d
@@ -277,16 +491,17 @@ class ncEarth(object):
         the kml string describing the GroundOverlay.  Optionally, the filename
         used to write the image can be specified, otherwise a default will be used.'''
         
-        vdata=self.get_array(varname)
+        vdata=self.get_frame(varname)
+        scale=self.get_scale(varname)
         min,max=self.get_minmax(varname)
-        im=self.get_image(vdata,min,max)
+        vdata=self.crop_array(varname,vdata,scale)
+        im=self.get_image(vdata,min,max,None,scale)
         if filename is None:
             filename='%s.png' % varname
         f=open(filename,'w')
         f.write(im)
         f.close()
         d=self.get_kml_dict(varname,filename)
-        pylab.close('all')
         return self.__class__.kmlimageStatic % d
 
     def image2kml(self,varname,filename=None,relfilename=None):
@@ -295,30 +510,52 @@ class ncEarth(object):
         the kml string describing the GroundOverlay.  Optionally, the filename
         used to write the image can be specified, otherwise a default will be used.'''
         
-        vdata=self.get_array(varname)
-        min,max=self.get_minmax(varname)
-        im=self.get_image(vdata,min,max)
         if filename is None:
             filename='%s.png' % varname
+        if relfilename is None:
+            relfilename=filename
+        kml,im=self.image2kmlData(varname,relfilename)
         f=open(filename,'w')
         f.write(im)
         f.close()
-        if relfilename is None:
-            relfilename=filename
-        d=self.get_kml_dict(varname,relfilename)
-        return self.__class__.kmlimage % d
+        return kml
     
-    def colorbar2kml(self,varname,filename=None):
+    def image2kmlData(self,varname,relfilename):
+        '''Like image2kml, but return the kml string referring to the image as
+        relfilename and the png image itself without writing any file.'''
+        vdata=self.get_frame(varname)
+        scale=self.get_scale(varname)
         min,max=self.get_minmax(varname)
-        label=self.get_label(varname)
-        cdata=self.get_colorbar(varname,label,min,max)
+        vdata=self.crop_array(varname,vdata,scale)
+        reduced=self.reduce_array(vdata)
+        im=self.get_image(vdata,min,max,reduced,scale)
+        d=self.get_kml_dict(varname,relfilename)
+        if self.frames is not None:
+            if reduced is None:
+                reduced=vdata
+            if scale != 1.:
+                reduced=reduced*scale
+            self.frames.put(varname,self.istep,self.view_function(reduced),min,max,
+                            self.logscale,self.get_label(varname),d,png_size(im))
+        return (self.__class__.kmlimage % d,im)
+    
+    def colorbar2kml(self,varname,filename=None,relfilename=None):
         if filename is None:
             filename='colorbar_%s.png' % varname
+        if relfilename is None:
+            relfilename=filename
+        kml,cdata=self.colorbar2kmlData(varname,relfilename)
         f=open(filename,'w')
         f.write(cdata)
         f.close()
-        pylab.close('all')
-        return self.__class__.kmlcolorbar % {'name':varname,'file':filename}
+        return kml
+
+    def colorbar2kmlData(self,varname,relfilename):
+        '''Return the kml string and the png image of a colorbar.'''
+        min,max=self.get_minmax(varname)
+        label=self.get_label(varname)
+        cdata=self.get_colorbar(varname,label,min,max)
+        return (self.__class__.kmlcolorbar % {'name':varname,'file':relfilename},cdata)
 
     def get_label(self,varname):
         return ''
@@ -349,22 +586,25 @@ class ncEarth(object):
         f.close()
 
 class ncEarth_log(ncEarth):
+    pool='max'  # keep narrow features (fire fronts) when downsampling
+    logscale=True
+
     def view_function(self,v):
+        # the log norm takes the logarithm and masks values <= 0
         if v.max() <= 0.:
             raise ZeroArray()
-        v=np.ma.masked_equal(v,0.,copy=False)
-        v.fill_value=np.nan
-        v=np.log(v)
         return v
 
     def get_norm(self,min,max):
+        from matplotlib.colors import LogNorm
         return LogNorm(min,max)
 
     def get_formatter(self):
+        from matplotlib.ticker import LogFormatter
         return LogFormatter(10,labelOnlyBase=False)
 
     def compute_minmax(self,vname):
-        v=self.f.variables[vname][:]
+        v=self.get_series(vname)
         if v[v>0].size == 0:
             min=1e-6
             max=1.
@@ -401,21 +641,45 @@ class ncWRFFireBase(object):
     progname='WRF-Fire'
     wrftimestr='%Y-%m-%d_%H:%M:%S'
     
-    def __init__(self,filename,hsize=5,istep=0):
+    def __init__(self,filename,hsize=5,istep=0,level=None,height=None,pressure=None,**kwargs):
         '''Overloaded constructor for WRF output files:
            filename : output NetCDF file
            hsize : output image width in inches
-           istep : time slice to output (between 0 and the number of timeslices in the file - 1)'''
-        ncEarth.__init__(self,filename,hsize)
+           istep : time slice to output (between 0 and the number of timeslices in the file - 1)
+           level : model level of 4D variables (default 0)
+           height : instead of a model level, interpolate 4D variables to this
+                    height above ground in m
+           pressure : instead of a model level, interpolate 4D variables to this
+                      pressure in Pa
+           other keyword arguments are passed to ncEarth'''
+        ncEarth.__init__(self,filename,hsize,**kwargs)
         self.istep=istep
+        self.level=level
+        self.height=height
+        self.pressure=pressure
+    
+    def get_levelspec(self):
+        '''Return the vertical level of 4D variables as ('level',index),
+        ('height',m) or ('pressure',Pa).'''
+        if self.height is not None:
+            return ('height',float(self.height))
+        if self.pressure is not None:
+            return ('pressure',float(self.pressure))
+        return ('level',int(self.level or 0))
+    
+    def varkey(self,vname):
+        key=(self.filename,vname)
+        if len(self.get_dims(vname)) == 4:
+            key=key+self.get_levelspec()
+        return key
     
     def get_bounds(self):
         '''Get the latitude and longitude bounds for an output domain.  In general,
         we need to reproject the data to a regular lat/lon grid.  This can be done
         with matplotlib's BaseMap module, but is not done here.'''
         
-        lat=self.f.variables['XLAT'][0,:,:].squeeze()
-        lon=self.f.variables['XLONG'][0,:,:].squeeze()
+        lat=self.get_geometry('XLAT')
+        lon=self.get_geometry('XLONG')
         dx=lon[0,1]-lon[0,0]
         dy=lat[1,0]-lat[0,0]
         #lat1=np.min(lat)-dy/2.
@@ -428,8 +692,28 @@ class ncWRFFireBase(object):
         lon2=lon[0,-1]+dx/2.
         return (lon1,lon2,lat1,lat2)
     
+    def get_geometry(self,name):
+        '''Return the first time slice of a coordinate array (XLAT, XLONG, FXLAT,
+        FXLONG), from shared memory if another process provided it.'''
+        key=(self.filename,name)
+        if geometry.has_key(key):
+            return geometry[key]
+        return self.f.variables[name][0,:,:].squeeze()
+
+    def get_dims(self,vname):
+        '''Return the dimensions of a variable, of a derived variable those of its
+        first source.'''
+        return self.f.variables[source_name(vname)].dimensions
+
+    def get_cellsize(self,vname):
+        '''Return the grid spacing (dx,dy) of a variable in m.'''
+        dx,dy=float(self.f.DX),float(self.f.DY)
+        if self.isfiregrid(vname):
+            dx,dy=dx/self.srx(),dy/self.sry()
+        return (dx,dy)
+
     def isfiregrid(self,vname):
-        xdim=self.f.variables[vname].dimensions[-1]
+        xdim=self.get_dims(vname)[-1]
         return xdim[-7:] == 'subgrid'
 
     def srx(self):
@@ -448,15 +732,114 @@ class ncWRFFireBase(object):
 
     def get_array(self,vname):
         '''Return a single time slice of a variable from a WRF output file.'''
+        if self.arrays.has_key(vname):
+            v=self.arrays[vname]
+            if self.get_scale(vname) != 1.:
+                v=v*self.get_scale(vname)
+            return v
+        v=self.get_slice(vname,self.istep)
+        return self.orient(vname,v)
+
+    def get_frame(self,vname):
+        '''Return the time slice of get_array, of a derived variable with a scale
+        factor the slice of its source, which is not converted.'''
+        if self.arrays.has_key(vname):
+            return self.arrays[vname]
+        if self.get_scale(vname) == 1.:
+            return self.get_array(vname)
+        return self.orient(vname,self.get_source(source_name(vname),self.istep))
+
+    def get_scale(self,vname):
+        if derived.has_key(vname) and derived[vname].scale is not None:
+            return derived[vname].scale
+        return 1.
+    
+    def get_slice(self,vname,istep):
+        '''Return the 2D field of a file or derived variable at a time step.
+        Derived fields and the source slices they are computed from are kept in
+        a bounded cache, so every source is read once per time step even if it
+        is used by several derived variables or time steps.  Arrays from the
+        cache must not be changed in place.'''
+        if not derived.has_key(vname):
+            return self.read_slice(vname,istep)
+        if istep < 0:
+            istep=istep+self.f.variables[source_name(vname)].shape[0]
+        return cached(self.varkey(vname)+(istep,),lambda: derived[vname].evaluate(self,istep))
+
+    def get_source(self,vname,istep):
+        '''Return the 2D field of a file variable at a time step through the cache.'''
+        return cached(('source',)+self.varkey(vname)+(istep,),lambda: self.read_slice(vname,istep))
+
+    def read_slice(self,vname,istep):
+        '''Read the 2D field of a variable at a time step, 4D variables at the
+        selected level.  Only the levels needed are read from the file, and
+        variables on staggered grids are averaged to the mass grid.'''
         v=self.f.variables[vname]
-        v=v[self.istep,:,:].squeeze()
+        if v.ndim < 4:
+            return destagger(v.dimensions,v[istep,:,:].squeeze())
+        kind,target=self.get_levelspec()
+        if kind == 'level':
+            return destagger(v.dimensions,v[istep,target,:,:])
+        k,w,valid=self.get_weights(istep,v.dimensions[1][-5:] == '_stag')
+        if not valid.any():
+            return np.ma.masked_all(w.shape)
+        k1=k[valid].min()
+        k2=k[valid].max()+2
+        a=destagger(v.dimensions,v[istep,k1:k2,:,:])
+        k=np.clip(k-k1,0,k2-k1-2)[np.newaxis]
+        lo=np.take_along_axis(a,k,0)[0]
+        hi=np.take_along_axis(a,k+1,0)[0]
+        return np.ma.masked_where(~valid,lo+w*(hi-lo))
+
+    def get_series(self,vname):
+        if derived.has_key(vname) and derived[vname].elementwise(self.f):
+            return derived[vname].function(*[self.f.variables[n][:] for n,o in derived[vname].sources])
+        v=self.f.variables[source_name(vname)]
+        if v.ndim < 4 and not derived.has_key(vname):
+            return v[:]
+        return np.ma.array([self.get_slice(vname,i) for i in xrange(v.shape[0])])
+
+    def get_vcoord(self,istep,kind,stag):
+        '''Return the vertical coordinate (nz,ny,nx) of a time step increasing
+        with the level index: the height above ground or minus the pressure on
+        the mass levels or the staggered levels.'''
+        if kind == 'height':
+            z=(self.f.variables['PH'][istep,:,:,:]+self.f.variables['PHB'][istep,:,:,:])/9.81
+            z=z-z[0]
+            if not stag:
+                z=0.5*(z[:-1]+z[1:])
+            return z
+        p=-(self.f.variables['P'][istep,:,:,:]+self.f.variables['PB'][istep,:,:,:])
+        if stag:
+            p=np.concatenate((p[:1],0.5*(p[:-1]+p[1:]),p[-1:]))
+        return p
+
+    def get_weights(self,istep,stag):
+        '''Return the interpolation weights (k,w,valid) of the selected height or
+        pressure at a time step, see vertical_weights.  The weights of each
+        column are computed once and shared by all variables on the same levels.'''
+        global vweights
+        kind,target=self.get_levelspec()
+        key=(self.filename,istep,kind,target,stag)
+        with lock:
+            if vweights.has_key(key):
+                return vweights[key]
+        if kind == 'pressure':
+            target=-target
+        w=vertical_weights(self.get_vcoord(istep,kind,stag),target)
+        with lock:
+            vweights[key]=w
+            while len(vweights) > maxweights:
+                vweights.popitem(last=False)
+        return w
+
+    def orient(self,vname,v):
+        '''Strip the extra row and column of the fire subgrid and flip to image
+        orientation.'''
         if self.isfiregrid(vname):
-            v=v[:-self.sry(),:-self.srx()]
-        v=pylab.flipud(v)
-        if vname == 'FGRNHFX' or vname == 'GRNHFX':
-            v[:]=v*0.239005736
-        return v
-    
+            v=v[...,:-self.sry(),:-self.srx()]
+        return np.flipud(v)
+
     def get_dates(self):
         t1=self.f.variables["Times"][0,:].tostring()
         t2=self.f.variables["Times"][-1,:].tostring()
@@ -486,6 +869,8 @@ class ncWRFFireBase(object):
         return time
 
     def get_label(self,varname):
+        if derived.has_key(varname):
+            return derived[varname].units
         v=self.f.variables[varname]
         return v.units
 
@@ -495,32 +880,591 @@ class ncWRFFire(ncWRFFireBase,ncEarth):
 class ncWRFFireLog(ncWRFFireBase,ncEarth_log):
     pass
 
-def create_image(fname,istep,nstep,vname,vstr,logscale,colorbar,imgs,content):
+def destagger(dims,v):
+    '''Average a field on a horizontally staggered grid (dimensions west_east_stag
+    or south_north_stag) to the mass grid.'''
+    if dims[-1] == 'west_east_stag':
+        v=0.5*(v[...,:-1]+v[...,1:])
+    if dims[-2] == 'south_north_stag':
+        v=0.5*(v[...,:-1,:]+v[...,1:,:])
+    return v
+
+def vertical_weights(z,target):
+    '''Return the interpolation weights of target in every column of a vertical
+    coordinate z (nz,ny,nx) increasing with the level index as (k,w,valid): the
+    value at target is v[k]+w*(v[k+1]-v[k]), valid is False in columns that do
+    not contain target.'''
+    k=(z <= target).sum(axis=0)-1
+    valid=(k >= 0) & (k < z.shape[0]-1)
+    k=np.clip(k,0,z.shape[0]-2)
+    z1=np.take_along_axis(z,k[np.newaxis],0)[0]
+    z2=np.take_along_axis(z,k[np.newaxis]+1,0)[0]
+    w=np.where(valid,(target-z1)/np.where(z2 > z1,z2-z1,1.),0.)
+    return (k,w,valid)
+
+def cached(key,compute):
+    '''Return the array stored in slices under key, calling compute to create it
+    if it is not there.  The least recently used arrays are dropped when the
+    cache holds more than maxslices bytes.'''
+    global slices
+    with lock:
+        if slices.has_key(key):
+            v=slices.pop(key)
+            slices[key]=v
+            return v
+    v=compute()
+    with lock:
+        slices[key]=v
+        while len(slices) > 1 and sum([a.nbytes for a in slices.values()]) > maxslices:
+            slices.popitem(last=False)
+    return v
+
+class ncDerived(object):
+
+    '''A variable computed from variables of a WRF output file by a vectorized
+    numpy expression.  Derived variables are used like the variables in the
+    file, see register.'''
+
+    def __init__(self,name,sources,function,units='',log=False,cellsize=False,scale=None):
+        '''Class constructor:
+           name : name of the derived variable
+           sources : names of the file variables the function is applied to, a
+                     pair (name,offset) selects the time step istep+offset
+                     (clipped to the time steps in the file)
+           function : function of the source arrays returning the derived array,
+                      the arrays are 2D slices (or 3D time series if the function
+                      is elementwise), or None with scale
+           units : units of the derived variable
+           log : optional, plot with a logarithmic color scale by default
+           cellsize : optional, pass the grid spacing dx,dy in m to function
+                      after the source arrays
+           scale : optional, a positive factor that the single source is
+                   multiplied by; images are colored from the source with the
+                   factor applied by ncFrameKernel, without computing the
+                   derived array'''
+        self.name=name
+        self.sources=[isinstance(s,tuple) and s or (s,0) for s in sources]
+        if scale is not None:
+            if len(self.sources) != 1 or self.sources[0][1] or cellsize or scale <= 0.:
+                raise ValueError("A scale factor requires a single source at the same time step.")
+            if function is None:
+                function=lambda v: v*scale
+        self.scale=scale
+        self.function=function
+        self.units=units
+        self.log=log
+        self.cellsize=cellsize
+
+    def elementwise(self,f):
+        '''Return True if the function can be applied to whole time series of the
+        sources in file f at once.'''
+        if self.cellsize or [o for n,o in self.sources if o]:
+            return False
+        dims=[f.variables[n].dimensions for n,o in self.sources]
+        return len(dims[0]) == 3 and dims.count(dims[0]) == len(dims) and \
+               not [d for d in dims[0] if d[-5:] == '_stag']
+
+    def evaluate(self,obj,istep):
+        '''Compute the 2D field at a time step for an ncWRFFireBase object.'''
+        nt=obj.f.variables[self.sources[0][0]].shape[0]
+        args=[obj.get_source(n,min(max(istep+o,0),nt-1)) for n,o in self.sources]
+        if self.cellsize:
+            args.extend(obj.get_cellsize(self.name))
+        return self.function(*args)
+
+# derived variables by name, a derived variable can have the name of a file
+# variable it replaces
+derived={}
+
+def register(name,sources,function,units='',log=False,cellsize=False,scale=None):
+    '''Register a derived variable, see ncDerived, for example
+
+    register('WSPD10',('U10','V10'),np.hypot,'m s-1')
+    register('FGRNHFX_KW',('FGRNHFX',),None,'kW m-2',scale=0.001)'''
+    derived[name]=ncDerived(name,sources,function,units,log,cellsize,scale)
+    return derived[name]
+
+def source_name(vname):
+    '''Return the file variable that gives the dimensions of a variable.'''
+    if derived.has_key(vname):
+        return derived[vname].sources[0][0]
+    return vname
+
+def rate_of_spread(tign,tign0,dx,dy):
+    '''Return the fire rate of spread in m/s as the inverse gradient of the
+    ignition time, in the cells where the ignition time changed since the
+    previous time step.'''
+    gy,gx=np.gradient(np.asarray(tign,np.float64),dy,dx)
+    g=np.hypot(gx,gy)
+    return np.ma.masked_where((tign == tign0) | (g == 0.),1./np.where(g > 0.,g,1.))
+
+# the ground heat flux is plotted in cal m-2 s-1
+register('FGRNHFX',('FGRNHFX',),None,'cal m-2 s-1',log=True,scale=0.239005736)
+register('GRNHFX',('GRNHFX',),None,'cal m-2 s-1',log=True,scale=0.239005736)
+register('FGRNHFX_KW',('FGRNHFX',),None,'kW m-2',log=True,scale=0.001)
+register('WSPD10',('U10','V10'),np.hypot,'m s-1')
+register('WSPD',('U','V'),np.hypot,'m s-1')
+register('ROS',('TIGN_G',('TIGN_G',-1)),rate_of_spread,'m s-1',cellsize=True)
+
+def active_window(m,margin=0):
+    '''Return the bounding box (i1,i2,j1,j2) of the true cells of a 2D boolean
+    array padded by margin cells, or None if there are no true cells.'''
+    rows=np.flatnonzero(m.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols=np.flatnonzero(m.any(axis=0))
+    i1=max(rows[0]-margin,0)
+    i2=min(rows[-1]+1+margin,m.shape[0])
+    j1=max(cols[0]-margin,0)
+    j2=min(cols[-1]+1+margin,m.shape[1])
+    return (i1,i2,j1,j2)
+
+def block_reduce(v,factor,pool='mean'):
+    '''Downsample a 2D array by reducing factor x factor blocks of cells with
+    their mean or max.  Partial blocks at the end of each axis are reduced over
+    the cells they contain, so the result covers the same extent as v.'''
+    if factor <= 1:
+        return v
+    v=np.ma.filled(v,np.nan)
+    i=np.arange(0,v.shape[0],factor)
+    j=np.arange(0,v.shape[1],factor)
+    if pool == 'max':
+        return np.fmax.reduceat(np.fmax.reduceat(v,i,axis=0),j,axis=1)
+    elif pool == 'mean':
+        s=np.add.reduceat(np.add.reduceat(v,i,axis=0),j,axis=1)
+        n=np.outer(np.diff(np.append(i,v.shape[0])),np.diff(np.append(j,v.shape[1])))
+        return s/n
+    else:
+        raise ValueError("Unknown pooling method %s" % pool)
+
+def get_lut(name='jet'):
+    '''Return the lookup table of a colormap as an (ncolors+1,4) uint8 RGBA array.
+    The last entry is the transparent color of masked values.  Only colormaps
+    other than jet require matplotlib.'''
+    global luts
+    if not luts.has_key(name):
+        if name == 'jet':
+            x=np.linspace(0.,1.,ncolors)
+            lut=np.ones((ncolors,4))
+            for i,c in enumerate(('red','green','blue')):
+                lut[:,i]=np.interp(x,[p[0] for p in jetdata[c]],[p[1] for p in jetdata[c]])
+        else:
+            lut=get_pylab().cm.get_cmap(name,ncolors)(np.arange(ncolors))
+        lut=np.vstack((lut,[[1.,1.,1.,0.]]))
+        luts[name]=(lut*255).astype(np.uint8)
+    return luts[name]
+
+class ncFrameKernel(object):
+    
+    '''Maps frames to colormap indices and RGBA images in a single pass of in
+    place operations over work buffers that are allocated for the first frame of
+    a given shape and reused for all following frames.  The results are the
+    same as those of the separate numpy operations in benchmark.py, and match
+    the matplotlib norms of get_norm.  An instance must not be used by more
+    than one thread, get_kernel returns the kernel of the current thread.'''
+    
+    def __init__(self):
+        self.shape=None
+        self.nalloc=0   # number of times the buffers were allocated
+    
+    def buffers(self,shape):
+        if shape != self.shape:
+            self.work=np.empty(shape,np.float32)
+            self.bad=np.empty(shape,np.bool_)
+            self.index=np.empty(shape,np.intp)
+            self.rgba=np.empty(shape+(4,),np.uint8)
+            self.shape=shape
+            self.nalloc=self.nalloc+1
+    
+    def quantize(self,v,min,max,log=False,n=ncolors,scale=1.):
+        '''Return the colormap index 0..n-1 of each value of a 2D array multiplied
+        by scale and normalized to [min,max] on a linear or log scale, and n for
+        masked and non-finite values (and values <= 0 on a log scale).  The
+        result is a buffer that is overwritten by the next call.'''
+        self.buffers(v.shape)
+        w=self.work
+        bad=self.bad
+        np.copyto(w,np.ma.getdata(v),casting='unsafe')
+        if scale != 1.:
+            np.multiply(w,scale,out=w)
+        if np.ma.is_masked(v):
+            np.copyto(w,np.nan,where=np.ma.getmaskarray(v))
+        if log:
+            np.less_equal(w,0.,out=bad)
+            np.copyto(w,np.nan,where=bad)
+            np.log(w,out=w)
+            min,max=np.log(min),np.log(max)
+        if max == min:
+            np.multiply(w,0.,out=w)
+        else:
+            np.subtract(w,min,out=w)
+            np.divide(w,float(max-min),out=w)
+        np.multiply(w,n,out=w)
+        np.isfinite(w,out=bad)
+        np.logical_not(bad,out=bad)
+        np.floor(w,out=w)
+        np.clip(w,0,n-1,out=w)
+        np.copyto(self.index,w,casting='unsafe')
+        np.copyto(self.index,n,where=bad)
+        return self.index
+    
+    def colorize(self,v,min,max,lut,log=False,scale=1.):
+        '''Return the RGBA image of a 2D array multiplied by scale and colored
+        with a lookup table from get_lut, in a buffer that is overwritten by the
+        next call.'''
+        idx=self.quantize(v,min,max,log,lut.shape[0]-1,scale)
+        return np.take(lut,idx,axis=0,out=self.rgba,mode='clip')
+
+def get_kernel():
+    '''Return the ncFrameKernel of the current thread.'''
+    global kernels
+    if not hasattr(kernels,'kernel'):
+        kernels.kernel=ncFrameKernel()
+    return kernels.kernel
+
+def colorbar_image(title,label,norm,formatter=None,cmap=None):
+    '''Draw a colorbar with matplotlib for a norm and tick formatter and an
+    optional colormap name.  Returns a png image as a string.'''
+    import cStringIO
+    from matplotlib.colorbar import ColorbarBase
+    pylab=get_pylab()
+    fig=pylab.figure(figsize=(2,5))
+    ax=fig.add_axes([0.35,0.03,0.1,0.9])
+    if cmap is not None:
+        cmap=pylab.cm.get_cmap(cmap)
+    if formatter:
+        cb1 = ColorbarBase(ax,cmap=cmap,norm=norm,format=formatter,spacing='proportional',orientation='vertical')
+    else:
+        cb1 = ColorbarBase(ax,cmap=cmap,norm=norm,spacing='proportional',orientation='vertical')
+    cb1.set_label(label,color='1')
+    ax.set_title(title,color='1')
+    for tl in ax.get_yticklabels():
+        tl.set_color('1')
+    im=cStringIO.StringIO()
+    fig.savefig(im,dpi=300,format='png',transparent=True)
+    pylab.close(fig)
+    s=im.getvalue()
+    im.close()
+    return s
+
+def png_image(rgba):
+    '''Encode an (ny,nx,4) uint8 RGBA array as a png image.  Returns the png
+    file as a string.'''
+    import struct,zlib
+    def chunk(tag,data):
+        return struct.pack('>I',len(data))+tag+data+struct.pack('>I',zlib.crc32(tag+data) & 0xffffffff)
+    ny,nx=rgba.shape[:2]
+    raw=np.zeros((ny,4*nx+1),np.uint8)  # each row starts with filter type 0
+    raw[:,1:]=rgba.reshape(ny,4*nx)
+    return '\x89PNG\r\n\x1a\n'+ \
+           chunk('IHDR',struct.pack('>IIBBBBB',nx,ny,8,6,0,0,0))+ \
+           chunk('IDAT',zlib.compress(raw.tostring(),6))+ \
+           chunk('IEND','')
+
+def png_size(png):
+    '''Return the size (width,height) in pixels of a png image given as a string.'''
+    import struct
+    return struct.unpack('>II',png[16:24])
+
+def write_kmz(kmz,kml,imgs,path=''):
+    '''Create a kmz file from the main kml string and a list (or iterator) of
+    images, either image files that are stored under their names relative to
+    path or pairs (name,png) of png images in memory.'''
+    import zipfile
+    z=zipfile.ZipFile(kmz,'w',compression=zipfile.ZIP_DEFLATED)
+    z.writestr(os.path.basename(kmz)[:-3]+'kml',kml)
+    for img in imgs:
+        if isinstance(img,tuple):
+            name,png=img
+            info=zipfile.ZipInfo(name)
+            info.external_attr=0644<<16
+            # png data is already compressed
+            z.writestr(info,png,zipfile.ZIP_STORED)
+        else:
+            z.write(os.path.join(path,img),img)
+    z.close()
+
+def jsonstats(stats):
+    '''Return statistics from ncEarth.get_stats in a json serializable form.'''
+    mm,box=stats
+    if box is not None:
+        box=[int(i) for i in box]
+    return [[float(mm[0]),float(mm[1])],box]
+
+def filehash(filename):
+    '''Return the sha1 hex digest of the contents of a file.'''
+    h=hashlib.sha1()
+    f=open(filename,'rb')
+    while True:
+        s=f.read(1<<20)
+        if not s:
+            break
+        h.update(s)
+    f.close()
+    return h.hexdigest()
+
+class ncManifest(object):
+    
+    '''A record of the frames completed by an export, kept as a small json lines
+    file so that an interrupted export can be resumed.  For every frame the kml
+    fragment and the content hashes of the files written are saved, along with
+    the normalization (color limits, options) that the whole export used.  The
+    first line holds the normalization and every completed frame appends one
+    line, so recording a frame does not rewrite the frames before it.  The file
+    is compacted when it is opened and closed.'''
+    
+    def __init__(self,filename,norm=None,path=None,resume=True):
+        '''Class constructor:
+           filename : json lines file to store the manifest in
+           norm : json serializable description of the normalization, frames
+                  recorded with a different normalization are discarded
+           path : directory the frame files are relative to (default the
+                  current directory)
+           resume : optional, if False start a new manifest'''
+        self.filename=filename
+        self.norm=json.loads(json.dumps(norm))
+        self.path=path or ''
+        self.frames={}
+        self.file=None
+        self.lock=threading.RLock()
+        if resume and os.path.exists(filename):
+            self.frames=self.load()
+        self.save()
+
+    def load(self):
+        '''Return the frames recorded in the file if its normalization matches.'''
+        f=open(self.filename,'r')
+        lines=f.readlines()
+        f.close()
+        frames={}
+        for i,line in enumerate(lines):
+            try:
+                d=json.loads(line)
+            except ValueError:
+                if i == 0:
+                    return {}
+                # a line cut off by an interrupted export
+                continue
+            if i == 0:
+                if d.get('norm') != self.norm:
+                    return {}
+            else:
+                frames[d['key']]={'kml':d['kml'],'files':d['files']}
+        return frames
+
+    def get(self,key):
+        '''Return (True,kml) if a frame was completed and all of its files are
+        unchanged, otherwise (False,None).'''
+        with self.lock:
+            frame=self.frames.get(str(key))
+        if frame is None:
+            return (False,None)
+        for name,h in frame['files']:
+            name=os.path.join(self.path,name)
+            if not os.path.exists(name) or filehash(name) != h:
+                return (False,None)
+        return (True,frame['kml'])
+
+    def add(self,key,kml,files=()):
+        '''Record a completed frame, its kml fragment (or None for frames without
+        output) and the files it wrote.'''
+        files=[(name,filehash(os.path.join(self.path,name))) for name in files]
+        with self.lock:
+            self.frames[str(key)]={'kml':kml,'files':files}
+            if self.file is None:
+                self.file=open(self.filename,'a')
+            self.file.write(json.dumps({'key':str(key),'kml':kml,'files':files})+'\n')
+            self.file.flush()
+
+    def save(self):
+        '''Rewrite the file with one line for each frame.'''
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file=None
+            tmp=self.filename+'.tmp'
+            f=open(tmp,'w')
+            f.write(json.dumps({'norm':self.norm})+'\n')
+            for key,frame in self.frames.items():
+                f.write(json.dumps({'key':key,'kml':frame['kml'],'files':frame['files']})+'\n')
+            f.close()
+            os.rename(tmp,self.filename)
+
+    def close(self):
+        self.save()
+
+def get_times(filename):
+    '''Return the times of all time slices of a WRF output file in kml (ISO 8601)
+    format.'''
+    f=Dataset(filename,'r')
+    times=f.variables['Times'][:]
+    f.close()
+    return [datetime.strptime(t.tostring(),ncWRFFireBase.wrftimestr).isoformat() for t in times]
+
+class ncChunkedKml(object):
+    
+    '''An animation split into kml documents (buckets) that hold the frames of a
+    fixed number of consecutive time steps.  A small root document links to every
+    bucket with a NetworkLink carrying the TimeSpan of its frames and a Region,
+    so that a viewer only loads the buckets of the current time window.  Each
+    bucket is written as soon as all of its frames have been added.'''
+    
+    # root kml document
+    rootstr= \
+    '''<?xml version="1.0" encoding="UTF-8"?>
+    <kml xmlns="http://www.opengis.net/kml/2.2">
+    <Folder>
+    <name>%(name)s</name>
+    %(content)s
+    </Folder>
+    </kml>'''
+    
+    # link to a bucket
+    linkstr= \
+    '''<NetworkLink>
+      <name>%(name)s</name>
+      <TimeSpan>
+      %(begin)s
+      %(end)s
+      </TimeSpan>
+      <Region>
+        <LatLonAltBox>
+          <north>%(lat2)f</north>
+          <south>%(lat1)f</south>
+          <east>%(lon2)f</east>
+          <west>%(lon1)f</west>
+        </LatLonAltBox>
+      </Region>
+      <Link>
+        <href>%(href)s</href>
+        <viewRefreshMode>onRegion</viewRefreshMode>
+      </Link>
+    </NetworkLink>'''
+    
+    def __init__(self,kmlfile,times,bounds,wrap,chunk=24,static=''):
+        '''Class constructor:
+           kmlfile : root kml file, buckets are written next to it as
+                     <name>_0000.kml, <name>_0001.kml, ...
+           times : times of the frames in kml format (see get_times)
+           bounds : (lon1,lon2,lat1,lat2) of the region covered by the frames
+           wrap : function returning the kml document of a bucket from the
+                  kml content of its frames
+           chunk : number of frames in a bucket
+           static : kml content of the root document (colorbar, ...)'''
+        self.kmlfile=kmlfile
+        self.times=times
+        self.bounds=bounds
+        self.wrap=wrap
+        self.chunk=chunk
+        self.nbucket=(len(times)+chunk-1)/chunk
+        self.frames={}
+        self.written=set()
+        self.lock=threading.RLock()
+        self.set_static(static)
+    
+    def bucketfile(self,b):
+        return '%s_%04i.kml' % (os.path.splitext(self.kmlfile)[0],b)
+    
+    def set_static(self,static):
+        '''Set the content of the root document and (re)write it.'''
+        lon1,lon2,lat1,lat2=self.bounds
+        links=[static]
+        for b in xrange(self.nbucket):
+            i1=b*self.chunk
+            i2=min(i1+self.chunk,len(self.times))
+            # like the frames, the first and last bucket are open ended
+            begin=end=''
+            if b > 0:
+                begin=ncEarth.beginstr % self.times[i1]
+            if i2 < len(self.times):
+                end=ncEarth.endstr % self.times[i2]
+            links.append(self.__class__.linkstr % \
+                         {'name':'%s - %s' % (self.times[i1],self.times[i2-1]),
+                          'begin':begin,'end':end,
+                          'lat1':lat1,'lat2':lat2,'lon1':lon1,'lon2':lon2,
+                          'href':os.path.basename(self.bucketfile(b))})
+        name=os.path.splitext(os.path.basename(self.kmlfile))[0]
+        with self.lock:
+            self.write(self.kmlfile,self.__class__.rootstr % {'name':name,'content':'\n'.join(links)})
+    
+    def add(self,istep,kml):
+        '''Add the kml of a frame (None for a frame without output), the bucket of
+        the frame is written when it is complete.'''
+        b=istep/self.chunk
+        with self.lock:
+            self.frames.setdefault(b,{})[istep]=kml
+            if len(self.frames[b]) == min(self.chunk,len(self.times)-b*self.chunk):
+                self.write_bucket(b)
+    
+    def write_bucket(self,b):
+        with self.lock:
+            frames=self.frames.pop(b,{})
+            content=[frames[i] for i in sorted(frames.keys()) if frames[i] is not None]
+            self.write(self.bucketfile(b),self.wrap('\n'.join(content)))
+            self.written.add(b)
+    
+    def write(self,filename,kml):
+        tmp=filename+'.tmp'
+        f=open(tmp,'w')
+        f.write(kml)
+        f.close()
+        os.rename(tmp,filename)
+    
+    def close(self):
+        '''Write the buckets that are not complete.'''
+        for b in xrange(self.nbucket):
+            if b not in self.written:
+                self.write_bucket(b)
+
+def create_image(fname,istep,nstep,vname,vstr,logscale,colorbar,imgs,content,manifest=None,chunks=None,**kwargs):
     global lock
     global queue
     queue.acquire()
-    i=istep
-    if logscale:
-        kml=ncWRFFireLog(fname,istep=istep)
-    else:
-        kml=ncWRFFire(fname,istep=istep)
-    if colorbar:
-        img='files/colorbar_%s.png' % vname
-        img_string=kml.colorbar2kml(vname,img)
-        with lock:
-            content.append(img_string)
-            imgs.append(img)
     try:
+        i=istep
+        if logscale:
+            kml=ncWRFFireLog(fname,istep=istep,**kwargs)
+        else:
+            kml=ncWRFFire(fname,istep=istep,**kwargs)
+        if colorbar:
+            img='files/colorbar_%s.png' % vname
+            done,img_string=(False,None)
+            if manifest is not None:
+                done,img_string=manifest.get('colorbar')
+            if not done:
+                img_string=kml.colorbar2kml(vname,img)
+                if manifest is not None:
+                    manifest.add('colorbar',img_string,(img,))
+            with lock:
+                content.append(img_string)
+                imgs.append(img)
+                if chunks is not None:
+                    chunks.set_static(img_string)
         img=vstr % (vname,istep)
-        img_string=kml.image2kml(vname,img)
+        done,img_string=(False,None)
+        if manifest is not None:
+            done,img_string=manifest.get(istep)
+        if not done:
+            try:
+                img_string=kml.image2kml(vname,img)
+            except ZeroArray:
+                img_string=None
+            if manifest is not None:
+                manifest.add(istep,img_string,img_string and (img,) or ())
         with lock:
-            content.append(img_string)
-            imgs.append(img)
-            print 'creating frame %i of %i' % (i,nstep)
-    except ZeroArray:
-        with lock:
-            print 'skipping frame %i of %i' % (i,nstep)
-    queue.release()
+            if chunks is not None:
+                chunks.add(istep,img_string)
+            if img_string is None:
+                print 'skipping frame %i of %i' % (i,nstep)
+            else:
+                content.append(img_string)
+                imgs.append(img)
+                if done:
+                    print 'reusing frame %i of %i' % (i,nstep)
+                else:
+                    print 'creating frame %i of %i' % (i,nstep)
+    finally:
+        queue.release()
 
 class ncWRFFire_mov(object):
     
@@ -573,38 +1517,79 @@ class ncWRFFire_mov(object):
              'prog':ncWRFFire.progname}
         
         # create a zipfile to store all images + kml into a single compressed file
-        z=zipfile.ZipFile(kmz,'w',compression=zipfile.ZIP_DEFLATED)
-        z.writestr(kmz[:-3]+'kml',kml)
-        for img in imgs:
-            z.write(img)
-        z.close()
+        write_kmz(kmz,kml,imgs)
 
-    def write(self,vname,kmz='fire.kmz',hsize=5,logscale=True,colorbar=True):
+    def write(self,vname,kmz='fire.kmz',hsize=5,logscale=True,colorbar=True,resume=False,chunk=None,**kwargs):
         '''Create a kmz file from multiple time steps of a wrfout file.
         vname : the variable name to visualize
-        kmz : optional, the name of the file to save the kmz to'''
+        kmz : optional, the name of the file to save the kmz to
+        resume : optional, keep the images of a previous (interrupted) export
+                 recorded in files/manifest_<vname>.json with the same
+                 normalization and only create the missing ones
+        chunk : optional, instead of the kmz write a root kml file (named like
+                the kmz) linking to kml files of chunk frames each, written
+                as the frames are done (see ncChunkedKml)
+        other keyword arguments (crop, npixels, nbytes, ...) are passed to ncWRFFire'''
         
         imgs=[]     # to store a list of all images created
         content=[]  # the content of the main kml
         threads=[]
         vstr='files/%s_%05i.png' # format specification for images (all stored in `files/' subdirectory)
         
-        # create empty files subdirectory for output images
-        try:
-            shutil.rmtree('files')
-        except:
-            pass
-        os.makedirs('files')
+        if resume:
+            if not os.path.isdir('files'):
+                os.makedirs('files')
+        else:
+            # create empty files subdirectory for output images
+            try:
+                shutil.rmtree('files')
+            except:
+                pass
+            os.makedirs('files')
         
-        # loop through all time slices and create the image data
-        # appending to the kml content string for each image
-        #k=0
+        # record the completed frames along with the normalization of this export
+        if logscale:
+            kml=ncWRFFireLog(self.filename,**kwargs)
+        else:
+            kml=ncWRFFire(self.filename,**kwargs)
+        norm={'vname':vname,'logscale':logscale,'options':kwargs,
+              'stats':jsonstats(kml.get_stats(vname))}
+        manifest=ncManifest('files/manifest_%s.json' % vname,norm,resume=resume)
+        
+        chunks=None
+        if chunk:
+            wrap=lambda content: ncWRFFire.kmlstr % {'content':content,'prog':ncWRFFire.progname}
+            chunks=ncChunkedKml(os.path.splitext(kmz)[0]+'.kml',get_times(self.filename)[:self.nstep],
+                                kml.get_bounds(),wrap,chunk)
+        
+        # create the images of all time slices on ncpu worker threads, which
+        # append to the kml content for each image; a thread keeps its frame
+        # kernel (see get_kernel) for all the frames it renders
+        steps=Queue.Queue()
         for i in xrange(0,self.nstep,1):
-            t=threading.Thread(target=create_image,args=(self.filename,i,self.nstep,vname,vstr,logscale,colorbar and i == 0,imgs,content))
+            steps.put(i)
+        def worker():
+            while True:
+                try:
+                    i=steps.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    create_image(self.filename,i,self.nstep,vname,vstr,logscale,colorbar and i == 0,
+                                 imgs,content,manifest,chunks,**kwargs)
+                except:
+                    traceback.print_exc()
+        for k in xrange(min(ncpu,self.nstep)):
+            t=threading.Thread(target=worker)
             t.start()
             threads.append(t)
         for t in threads:
             t.join()
+        manifest.close()
+        
+        if chunks is not None:
+            chunks.close()
+            return
 
         # create the main kml file
         kml=ncWRFFire.kmlstr % \
@@ -612,14 +1597,12 @@ class ncWRFFire_mov(object):
              'prog':ncWRFFire.progname}
         
         # create a zipfile to store all images + kml into a single compressed file
-        z=zipfile.ZipFile(kmz,'w',compression=zipfile.ZIP_DEFLATED)
-        z.writestr(kmz[:-3]+'kml',kml)
-        for img in imgs:
-            z.write(img)
-        z.close()
+        write_kmz(kmz,kml,imgs)
 
 
 def uselog(vname):
+    if derived.has_key(vname):
+        return derived[vname].log
     if vname in ('FGRNHFX','GRNHFX'):
         return True
     else:
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+'''
+A cache of the arrays that overlay images are colored from, so that an export
+can be restyled (colormap, transparency, color limits, log or linear scale)
+without reading the WRF output file again.  Each frame is saved cropped and
+downsampled like its image, quantized to 16 (or 8) bit integers with a scale
+and an offset:
+
+  <dir>/<var>/<istep>.npy   the quantized array, memory mapped when read
+  <dir>/<var>/<istep>.json  scale, offset, color limits, units, the pixel size
+                            of the image and the kml fields of the frame
+
+With compress=True the array is written zlib compressed to <istep>.npz instead
+of the .npy file.  The integer 0 marks masked cells.  Variables shown on a log
+scale are quantized in log space, so their cells <= 0 are masked.
+
+Use as follows:
+
+import ncEarth,ncFrames
+kml=ncEarth.ncWRFFireLog('wrfout',istep=istep,npixels=250000)
+kml.frames=ncFrames.ncFrameCache('frames')
+kml.image2kmlData('FGRNHFX','files/FGRNHFX_%05i.png' % istep)
+
+or ncBatch.py --cache, which fills <outdir>/<run>/frames, and write a restyled
+kmz from the cache with
+
+ncFrames.py [--cmap name] [--alpha 0-255] [--limits min max] [--log|--linear] dir var [kmz]
+'''
+
+import numpy as np
+import json
+import os,sys
+
+def quantize(v,log=False,dtype=np.uint16):
+    '''Return (q,offset,scale) with q an integer array such that v (log(v) on a log
+    scale) is offset+scale*(q-1) where q > 0, and q is 0 where v is masked or
+    not finite.'''
+    v=np.ma.masked_invalid(np.ma.asarray(v,np.float64),copy=False)
+    if log:
+        v=np.ma.log(np.ma.masked_less_equal(v,0.,copy=False))
+    if v.count() == 0:
+        return (np.zeros(v.shape,dtype),0.,1.)
+    n=np.iinfo(dtype).max-1
+    offset=float(v.min())
+    scale=(float(v.max())-offset)/n
+    if scale == 0.:
+        scale=1.
+    q=np.ma.filled(np.rint((v-offset)/scale)+1.,0.).astype(dtype)
+    return (q,offset,scale)
+
+def dequantize(q,offset,scale,log=False):
+    '''Return the masked array of values quantized by quantize.'''
+    v=(q-1.)*scale+offset
+    if log:
+        v=np.exp(v)
+    return np.ma.masked_where(q == 0,v,copy=False)
+
+def resize(rgba,nx,ny):
+    '''Scale an RGBA image to nx by ny pixels by nearest neighbor sampling, as
+    matplotlib scales the images rendered at hsize inches.'''
+    i=((np.arange(ny)+0.5)*rgba.shape[0]/float(ny)).astype(np.intp)
+    j=((np.arange(nx)+0.5)*rgba.shape[1]/float(nx)).astype(np.intp)
+    return rgba[i[:,np.newaxis],j]
+
+def jsonvalue(x):
+    if isinstance(x,np.generic):
+        return x.item()
+    return x
+
+class ncFrameCache(object):
+
+    '''Quantized frames in a directory, filled by ncEarth.image2kmlData when it
+    is set as the frames attribute of an ncEarth object.  Every frame has files
+    of its own, so several processes can write to one cache.'''
+
+    def __init__(self,dirname,dtype=np.uint16,compress=False):
+        '''Class constructor:
+           dirname : cache directory, created when the first frame is written
+           dtype : integer type of the quantized arrays, uint16 or uint8
+           compress : optional, write compressed .npz files instead of .npy files
+                      that are memory mapped when read'''
+        self.dirname=dirname
+        self.dtype=np.dtype(dtype)
+        self.compress=compress
+
+    def framefiles(self,vname,istep):
+        '''Return the array and the metadata file of a frame relative to the cache
+        directory.'''
+        ext=self.compress and 'npz' or 'npy'
+        return (os.path.join(vname,'%05i.%s' % (istep,ext)),os.path.join(vname,'%05i.json' % istep))
+
+    def put(self,vname,istep,v,min,max,log=False,label='',kml=None,size=None):
+        '''Save the array of a frame with the color limits and scale it was shown
+        with, its units, the fields of its kml GroundOverlay (see
+        ncEarth.get_kml_dict) and the size (width,height) of its image in pixels
+        if it differs from the array.  The metadata is written last, so a frame
+        is only visible to readers once it is complete.'''
+        d=os.path.join(self.dirname,vname)
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                # created by another process
+                pass
+        q,offset,scale=quantize(v,log,self.dtype)
+        afile,mfile=self.framefiles(vname,istep)
+        if self.compress:
+            np.savez_compressed(os.path.join(self.dirname,afile),q=q)
+        else:
+            np.save(os.path.join(self.dirname,afile),q)
+        meta={'file':os.path.basename(afile),'offset':offset,'scale':scale,'log':bool(log),
+              'min':float(min),'max':float(max),'label':label,
+              'size':size and [int(n) for n in size] or [v.shape[1],v.shape[0]],
+              'kml':dict([(k,jsonvalue(x)) for k,x in (kml or {}).items()])}
+        mfile=os.path.join(self.dirname,mfile)
+        f=open(mfile+'.tmp','w')
+        json.dump(meta,f)
+        f.close()
+        os.rename(mfile+'.tmp',mfile)
+
+    def get(self,vname,istep):
+        '''Return the array of a frame as a masked array and its metadata.'''
+        f=open(os.path.join(self.dirname,self.framefiles(vname,istep)[1]),'r')
+        meta=json.load(f)
+        f.close()
+        afile=os.path.join(self.dirname,vname,meta['file'])
+        if afile[-4:] == '.npz':
+            z=np.load(afile)
+            q=z['q']
+            z.close()
+        else:
+            q=np.load(afile,mmap_mode='r')
+        return (dequantize(q,meta['offset'],meta['scale'],meta['log']),meta)
+
+    def steps(self,vname):
+        '''Return the time steps of the cached frames of a variable.'''
+        d=os.path.join(self.dirname,vname)
+        if not os.path.isdir(d):
+            return []
+        return sorted([int(f[:-5]) for f in os.listdir(d) if f[-5:] == '.json'])
+
+    def variables(self):
+        if not os.path.isdir(self.dirname):
+            return []
+        return sorted([d for d in os.listdir(self.dirname) if self.steps(d)])
+
+def restyle(cache,vname,kmz=None,cmap='jet',alpha=None,limits=None,log=None,colorbar=True):
+    '''Write a kmz of the cached frames of a variable colored with another colormap,
+    transparency (0-255), color limits (min,max) or scale (log=True or False),
+    by default those of the export.  Images are colored with ncFrameKernel and
+    scaled to the pixel size of the exported images.  Only the colorbar
+    requires matplotlib.  Returns the number of frames written.'''
+    from ncEarth import ncWRFFire,get_kernel,get_lut,png_image,colorbar_image,write_kmz
+    if not isinstance(cache,ncFrameCache):
+        cache=ncFrameCache(cache)
+    if kmz is None:
+        kmz='fire_%s.kmz' % vname
+    lut=get_lut(cmap)
+    kernel=get_kernel()
+    content=[]
+    imgs=[]
+    meta=None
+    for istep in cache.steps(vname):
+        v,meta=cache.get(vname,istep)
+        if log is None:
+            log=meta['log']
+        if limits is None:
+            limits=(meta['min'],meta['max'])
+        if log and limits[0] <= 0.:
+            raise ValueError("Color limits must be positive on a log scale.")
+        d=dict(meta['kml'])
+        if alpha is not None:
+            d['alpha']=alpha
+        content.append(ncWRFFire.kmlimage % d)
+        rgba=kernel.colorize(v,limits[0],limits[1],lut,log)
+        nx,ny=meta.get('size',(v.shape[1],v.shape[0]))
+        if (ny,nx) != v.shape:
+            rgba=resize(rgba,nx,ny)
+        imgs.append((d['filename'],png_image(rgba)))
+    if colorbar and meta is not None:
+        if log:
+            from matplotlib.colors import LogNorm
+            from matplotlib.ticker import LogFormatter
+            norm=LogNorm(*limits)
+            formatter=LogFormatter(10,labelOnlyBase=False)
+        else:
+            from matplotlib.colors import Normalize
+            norm=Normalize(*limits)
+            formatter=None
+        img='files/colorbar_%s.png' % vname
+        content.insert(0,ncWRFFire.kmlcolorbar % {'name':vname,'file':img})
+        imgs.insert(0,(img,colorbar_image(vname,meta['label'],norm,formatter,cmap)))
+    kml=ncWRFFire.kmlstr % {'content':'\n'.join(content),'prog':ncWRFFire.progname}
+    write_kmz(kmz,kml,imgs)
+    return len(imgs)-int(colorbar and meta is not None)
+
+if __name__ == '__main__':
+    import argparse
+    parser=argparse.ArgumentParser(description='Write a restyled kmz from a cache of quantized frames.')
+    parser.add_argument('cache',help='frame cache directory (<outdir>/<run>/frames of ncBatch.py --cache)')
+    parser.add_argument('vname',metavar='var')
+    parser.add_argument('kmz',nargs='?',default=None,help='output file (default fire_<var>.kmz)')
+    parser.add_argument('--cmap',default='jet',help='colormap name (other than jet requires matplotlib)')
+    parser.add_argument('--alpha',type=int,default=None,help='opacity of the overlays, 0-255')
+    parser.add_argument('--limits',type=float,nargs=2,metavar=('MIN','MAX'),help='color limits')
+    parser.add_argument('--log',action='store_true',dest='log',default=None,help='logarithmic color scale')
+    parser.add_argument('--linear',action='store_false',dest='log',help='linear color scale')
+    parser.add_argument('--no-colorbar',action='store_false',dest='colorbar',help='leave out the colorbar')
+    args=parser.parse_args()
+    n=restyle(args.cache,args.vname,args.kmz,args.cmap,args.alpha,args.limits,args.log,args.colorbar)
+    print 'wrote %i frames to %s' % (n,args.kmz or 'fire_%s.kmz' % args.vname)
+    if n == 0:
+        sys.exit(1)
+    sys.exit(0)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+'''
+A read-only NetCDF backend for classic and 64-bit offset files that maps the
+file into memory and returns every variable slice as a numpy view into the
+mapping, without copying.  Only the parts of the interface of netCDF4.Dataset
+used by the ncEarth classes are provided: the dimensions and variables
+dictionaries, len() of dimensions, the shape, dimensions and attributes of
+variables, indexing of variables, and global attributes.
+
+Unlike netCDF4, values are not masked at _FillValue and scale_factor and
+add_offset are not applied (WRF output uses neither), and arrays are returned
+in the big endian byte order of the file.  Slices are read only, so copy them
+before changing them in place.
+
+Use as follows:
+
+import ncMmap
+f=ncMmap.Dataset('wrfout')
+v=f.variables['FGRNHFX'][istep,:,:]
+
+or through ncEarth.Dataset, which uses this backend for classic format files
+by default (see ncEarth.set_backend).
+'''
+
+import numpy as np
+import mmap
+import struct
+import os
+
+# nc_type codes of the format specification
+types={1:np.dtype('i1'),2:np.dtype('S1'),3:np.dtype('>i2'),
+       4:np.dtype('>i4'),5:np.dtype('>f4'),6:np.dtype('>f8')}
+NC_DIMENSION=10
+NC_VARIABLE=11
+NC_ATTRIBUTE=12
+STREAMING=0xffffffff
+
+def isclassic(filename):
+    '''Return True if a file is in the NetCDF classic or 64-bit offset format.'''
+    try:
+        f=open(filename,'rb')
+        magic=f.read(4)
+        f.close()
+    except IOError:
+        return False
+    return magic in ('CDF\x01','CDF\x02')
+
+class Dimension(object):
+
+    def __init__(self,name,size,unlimited=False):
+        self.name=name
+        self.size=size
+        self.unlimited=unlimited
+
+    def __len__(self):
+        return self.size
+
+    def isunlimited(self):
+        return self.unlimited
+
+class Variable(object):
+
+    '''A variable of a mapped file, indexing returns views of the mapping.'''
+
+    def __init__(self,name,dimensions,attributes,data):
+        self.__dict__['_attributes']=attributes
+        self.name=name
+        self.dimensions=dimensions
+        self.data=data
+        self.shape=data.shape
+        self.dtype=data.dtype
+        self.ndim=data.ndim
+
+    def __getattr__(self,name):
+        try:
+            return self._attributes[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def ncattrs(self):
+        return self._attributes.keys()
+
+    def getncattr(self,name):
+        return self._attributes[name]
+
+    def __getitem__(self,key):
+        return self.data[key]
+
+    def __len__(self):
+        return self.shape[0]
+
+class Dataset(object):
+
+    '''A NetCDF classic or 64-bit offset file mapped into memory.'''
+
+    def __init__(self,filename,mode='r'):
+        '''Class constructor:
+           filename : NetCDF file name
+           mode : only 'r' is supported'''
+        if mode != 'r':
+            raise ValueError("ncMmap only reads files.")
+        self.__dict__['_attributes']={}
+        self.filename=filename
+        f=open(filename,'rb')
+        size=os.fstat(f.fileno()).st_size
+        self.mm=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        f.close()
+        self.pos=0
+        magic=self.read(4)
+        if magic not in ('CDF\x01','CDF\x02'):
+            raise IOError("%s is not a NetCDF classic or 64-bit offset file." % filename)
+        self.offsetsize=magic == 'CDF\x02' and 8 or 4
+        numrecs=self.read_int()
+        dims=self.read_dimensions()
+        self._attributes.update(self.read_attributes())
+        vars=self.read_variables(dims)
+
+        # record variables are interleaved, one record of each after another
+        recvars=[v for v in vars if v[1] and dims[v[1][0]][1] == 0]
+        sizes=[int(np.prod([dims[d][1] for d in v[1][1:]]))*v[3].itemsize for v in recvars]
+        if len(recvars) == 1:
+            # a single record variable is not padded
+            recsize=sizes[0]
+        else:
+            recsize=sum([n+(-n)%4 for n in sizes])
+        if numrecs == STREAMING:
+            numrecs=0
+            if recvars and recsize:
+                numrecs=(size-min([v[5] for v in recvars]))/recsize
+
+        self.dimensions={}
+        for name,n in dims:
+            if n == 0:
+                self.dimensions[name]=Dimension(name,numrecs,True)
+            else:
+                self.dimensions[name]=Dimension(name,n)
+        self.variables={}
+        for name,dimids,attrs,dtype,vsize,begin in vars:
+            shape=[dims[d][1] for d in dimids]
+            isrec=bool(dimids) and shape[0] == 0
+            if isrec:
+                shape[0]=numrecs
+            strides=[]
+            s=dtype.itemsize
+            for n in reversed(shape):
+                strides.insert(0,s)
+                s=s*n
+            if isrec:
+                strides[0]=recsize
+            data=np.ndarray(tuple(shape),dtype,buffer=self.mm,offset=begin,strides=tuple(strides))
+            self.variables[name]=Variable(name,tuple([dims[d][0] for d in dimids]),attrs,data)
+
+    def read(self,n):
+        s=self.mm[self.pos:self.pos+n]
+        self.pos=self.pos+n
+        return s
+
+    def read_int(self):
+        return struct.unpack('>I',self.read(4))[0]
+
+    def read_offset(self):
+        if self.offsetsize == 8:
+            return struct.unpack('>Q',self.read(8))[0]
+        return self.read_int()
+
+    def read_name(self):
+        n=self.read_int()
+        s=self.read(n)
+        self.pos=self.pos+(-n)%4
+        return s
+
+    def read_list(self,tag):
+        t=self.read_int()
+        n=self.read_int()
+        if t not in (0,tag):
+            raise IOError("Invalid NetCDF header in %s." % self.filename)
+        return n
+
+    def read_dimensions(self):
+        return [(self.read_name(),self.read_int()) for i in xrange(self.read_list(NC_DIMENSION))]
+
+    def read_attributes(self):
+        attrs={}
+        for i in xrange(self.read_list(NC_ATTRIBUTE)):
+            name=self.read_name()
+            dtype=types[self.read_int()]
+            n=self.read_int()
+            s=self.read(n*dtype.itemsize)
+            self.pos=self.pos+(-n*dtype.itemsize)%4
+            if dtype.char == 'S':
+                attrs[name]=s.rstrip('\x00')
+            else:
+                v=np.fromstring(s,dtype).astype(dtype.newbyteorder('='))
+                if n == 1:
+                    v=v[0]
+                attrs[name]=v
+        return attrs
+
+    def read_variables(self,dims):
+        vars=[]
+        for i in xrange(self.read_list(NC_VARIABLE)):
+            name=self.read_name()
+            dimids=[self.read_int() for j in xrange(self.read_int())]
+            attrs=self.read_attributes()
+            dtype=types[self.read_int()]
+            vsize=self.read_int()
+            begin=self.read_offset()
+            vars.append((name,dimids,attrs,dtype,vsize,begin))
+        return vars
+
+    def __getattr__(self,name):
+        try:
+            return self._attributes[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def ncattrs(self):
+        return self._attributes.keys()
+
+    def getncattr(self,name):
+        return self._attributes[name]
+
+    def close(self):
+        '''Release the mapping, it is unmapped when no slices refer to it anymore.'''
+        self.variables={}
+        self.mm=None
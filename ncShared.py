@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+'''
+Shared memory transport of decoded arrays from a reader process to worker
+processes forked from it.  The reader decodes every frame (the result of
+ncEarth get_frame for one variable and time step) once into a slot of a ring
+buffer in shared memory, and the workers map the slot as a numpy array without
+copying.
+The coordinate arrays of each file (XLAT/XLONG, FXLAT/FXLONG) are shared the
+same way.  The shared memory must be allocated before the worker pool is
+created so that the workers inherit it:
+
+import multiprocessing,ncShared
+ring=ncShared.ncFrameRing(nslots,slotsize)
+geom=ncShared.share_geometry(filenames)
+pool=multiprocessing.Pool(initializer=ncShared.attach,initargs=(ring,geom))
+spec=ring.put(array,nusers)     # in the reader, pass spec to the workers
+v=ncShared.get_frame(spec)      # in a worker
+ring.release(spec[0])           # in the reader, after each user is done
+'''
+
+import numpy as np
+from multiprocessing.sharedctypes import RawArray
+import ncEarth
+
+geonames=('XLAT','XLONG','FXLAT','FXLONG')
+
+global ring
+ring=None
+
+class ncFrameRing(object):
+
+    '''A fixed number of float32 frame slots in shared memory.  Slots are handed
+    out and recycled by the reader process only.'''
+
+    def __init__(self,nslots,slotsize):
+        '''Class constructor:
+           nslots : number of frames that can be in use at the same time
+           slotsize : number of elements of the largest frame'''
+        self.nslots=nslots
+        self.slotsize=slotsize
+        self.buf=RawArray('f',nslots*slotsize)
+        self.free=range(nslots)
+        self.users={}
+
+    def view(self,slot,shape):
+        '''Return the array stored in a slot.'''
+        n=int(np.prod(shape))
+        a=np.frombuffer(self.buf,np.float32,count=n,offset=slot*self.slotsize*4)
+        return a.reshape(shape)
+
+    def put(self,v,users=1):
+        '''Copy an array into a free slot that is released after users calls of
+        release.  Masked values are stored as nan.  Returns the (slot,shape) that
+        workers pass to get_frame.'''
+        if not self.free:
+            raise Exception("No free slot in frame ring.")
+        if v.size > self.slotsize:
+            raise ValueError("Frame of size %i does not fit in a slot of size %i" % (v.size,self.slotsize))
+        slot=self.free.pop(0)
+        self.view(slot,v.shape)[...]=np.ma.filled(v,np.nan)
+        self.users[slot]=users
+        return (slot,v.shape)
+
+    def release(self,slot):
+        self.users[slot]=self.users[slot]-1
+        if self.users[slot] == 0:
+            del self.users[slot]
+            self.free.append(slot)
+
+def share_geometry(filenames,names=geonames):
+    '''Read the first time slice of the coordinate arrays of each file into shared
+    memory.  Returns a dictionary (filename,name) -> (buffer,shape) for attach.'''
+    geom={}
+    for filename in filenames:
+        f=ncEarth.Dataset(filename,'r')
+        for name in names:
+            if not f.variables.has_key(name):
+                continue
+            v=f.variables[name][0,:,:]
+            buf=RawArray('f',v.size)
+            np.frombuffer(buf,np.float32).reshape(v.shape)[...]=v
+            geom[(filename,name)]=(buf,v.shape)
+        f.close()
+    return geom
+
+def attach(frames,geom):
+    '''Worker initializer, map the frame ring and the shared coordinate arrays.'''
+    global ring
+    ring=frames
+    for key,(buf,shape) in geom.items():
+        ncEarth.geometry[key]=np.frombuffer(buf,np.float32).reshape(shape)
+
+def get_frame(spec):
+    '''Return the array of a frame stored by ncFrameRing.put (without copying).'''
+    return ring.view(*spec)
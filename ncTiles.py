@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+'''
+A single file store for rendered overlay images, in the style of MBTiles.
+Images are kept in a SQLite database keyed by (variable, timestep, zoom, x, y)
+together with the kml fragment of each frame, instead of as many small png
+files that are zipped afterwards.  Writes are collected into batched
+transactions, a store can be reopened and appended to, and a single frame is
+read back with one indexed query.  A complete frame is stored as the tile
+(zoom,x,y)=(0,0,0).
+
+Use as follows:
+
+import ncTiles
+store=ncTiles.ncTileStore('fire.mbtiles')
+store.put('FGRNHFX',istep,png,kml,href)
+store.close()
+
+and build a kmz from the store with
+
+ncTiles.py fire.mbtiles [var [kmz]]
+'''
+
+import sqlite3
+import os,sys
+
+colorbar=-1   # the timestep the colorbar of a variable is stored at
+
+schema= \
+'''CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tiles (variable TEXT, timestep INTEGER, zoom_level INTEGER,
+    tile_column INTEGER, tile_row INTEGER, tile_data BLOB,
+    PRIMARY KEY (variable,timestep,zoom_level,tile_column,tile_row));
+CREATE TABLE IF NOT EXISTS frames (variable TEXT, timestep INTEGER, kml TEXT, href TEXT,
+    PRIMARY KEY (variable,timestep));'''
+
+class ncTileStore(object):
+
+    '''Rendered images and their kml fragments in a SQLite database.  Only one
+    process should write to a store at a time.'''
+
+    def __init__(self,filename,batch=100,resume=True):
+        '''Class constructor:
+           filename : database file, created if it does not exist
+           batch : number of writes collected in one transaction
+           resume : optional, if False remove the contents of an existing store'''
+        self.filename=filename
+        self.batch=batch
+        self.pending=0
+        if not resume and os.path.exists(filename):
+            os.remove(filename)
+        self.db=sqlite3.connect(filename)
+        self.db.text_factory=str
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(schema)
+        self.db.execute("INSERT OR IGNORE INTO metadata VALUES ('format','png')")
+        self.db.commit()
+
+    def put(self,vname,istep,data,kml=None,href=None,zoom=0,x=0,y=0):
+        '''Store a png image, and for complete frames the kml fragment and the
+        file name the fragment refers to the image by.'''
+        self.db.execute('INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?,?)',
+                        (vname,istep,zoom,x,y,sqlite3.Binary(data)))
+        if kml is not None:
+            self.db.execute('INSERT OR REPLACE INTO frames VALUES (?,?,?,?)',
+                            (vname,istep,kml,href))
+        self.pending=self.pending+1
+        if self.pending >= self.batch:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending=0
+
+    def get(self,vname,istep,zoom=0,x=0,y=0):
+        '''Return a png image as a string or None if it is not stored.'''
+        r=self.db.execute('SELECT tile_data FROM tiles WHERE variable=? AND timestep=? AND '
+                          'zoom_level=? AND tile_column=? AND tile_row=?',
+                          (vname,istep,zoom,x,y)).fetchone()
+        if r is None:
+            return None
+        return str(r[0])
+
+    def has(self,vname,istep,zoom=0,x=0,y=0):
+        return self.db.execute('SELECT 1 FROM tiles WHERE variable=? AND timestep=? AND '
+                               'zoom_level=? AND tile_column=? AND tile_row=?',
+                               (vname,istep,zoom,x,y)).fetchone() is not None
+
+    def frames(self,vname):
+        '''Return a list of (timestep,kml,href) of the complete frames of a
+        variable ordered by timestep (the colorbar first).'''
+        return self.db.execute('SELECT timestep,kml,href FROM frames WHERE variable=? '
+                               'ORDER BY timestep',(vname,)).fetchall()
+
+    def variables(self):
+        return [r[0] for r in self.db.execute('SELECT DISTINCT variable FROM frames ORDER BY variable')]
+
+    def set_metadata(self,name,value):
+        self.db.execute('INSERT OR REPLACE INTO metadata VALUES (?,?)',(name,value))
+        self.pending=self.pending+1
+
+    def get_metadata(self,name):
+        r=self.db.execute('SELECT value FROM metadata WHERE name=?',(name,)).fetchone()
+        return r and r[0]
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+def extract(store,vname,kmz=None):
+    '''Write a kmz of all frames of a variable in a store, the images are copied
+    from the database directly into the zip file.'''
+    from ncEarth import ncWRFFire,write_kmz
+    if not isinstance(store,ncTileStore):
+        store=ncTileStore(store)
+    if kmz is None:
+        kmz='fire_%s.kmz' % vname
+    frames=store.frames(vname)
+    kml=ncWRFFire.kmlstr % {'content':'\n'.join([k for i,k,h in frames]),
+                            'prog':ncWRFFire.progname}
+    write_kmz(kmz,kml,((href,store.get(vname,i)) for i,k,href in frames))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print "Writes a kmz for each variable (or the one given) in a tile store."
+        print "usage: %s store [var [kmz]]" % sys.argv[0]
+        sys.exit(1)
+    store=ncTileStore(sys.argv[1])
+    if len(sys.argv) > 2:
+        vnames=[sys.argv[2]]
+    else:
+        vnames=store.variables()
+    for v in vnames:
+        if len(sys.argv) > 3:
+            kmz=sys.argv[3]
+        else:
+            kmz='fire_%s.kmz' % v
+        print 'writing %s' % kmz
+        extract(store,v,kmz)
+    store.close()